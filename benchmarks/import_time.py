@@ -0,0 +1,65 @@
+"""
+Import-time check for the job entry point.
+
+Runs `python -X importtime -c "import main"` from handlers/ and fails when main cannot be imported,
+when a heavy dependency is imported at module load or when the cumulative import time of main exceeds
+the budget. Cloud Build runs it in the freshly built image before the image is pushed.
+
+    python benchmarks/import_time.py [--budget-ms 300]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HANDLERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "handlers")
+
+# Dependencies that must only load once the stage that needs them runs
+LAZY_MODULES = ("pandas", "numpy", "google.cloud.storage", "google.cloud.secretmanager", "redbrick", "zstandard")
+
+
+def measure_imports(module="main"):
+    """Return {module: cumulative microseconds} as reported by -X importtime"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=HANDLERS_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="maximum cumulative import time of main")
+    args = parser.parse_args()
+
+    try:
+        timings = measure_imports()
+    except subprocess.CalledProcessError as e:
+        print(f"FAIL import main raised:\n{e.stderr}")
+        return 1
+    total_ms = timings["main"] / 1000
+    eager = [name for name in timings if name in LAZY_MODULES]
+
+    print(f"import main: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    failures = []
+    if eager:
+        failures.append(f"imported at module load: {', '.join(eager)}")
+    if total_ms > args.budget_ms:
+        failures.append(f"import time {total_ms:.1f} ms is over budget")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
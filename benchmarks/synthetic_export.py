@@ -0,0 +1,126 @@
+"""
+Seeded generator of synthetic RedBrick export tasks.
+
+The tasks have the shape returned by export_tasks(binary_mask=True): a superTruth that is sometimes
+missing, zero, one or three consensusTasks, a varying number of landmarks3d with and without their
+attributes, measurements that may not match any nodule group, and segmentMaps that are dicts, lists,
+empty or absent. The same seed always produces the same tasks.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+MEASUREMENT_CATEGORIES = (
+    "Nodule Volume 2D Min Diameter",
+    "Nodule Volume 2D Max Diameter",
+    "Nodule Volume 2D Mean Diameter",
+    "Nodule Core 2D Min Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Max Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Mean Diameter (Only for part-solid nodules)",
+    "Lesion Length",
+)
+
+NODULE_ATTRIBUTES = {
+    "Nodule Location": ("Right Upper Lobe", "Right Middle Lobe", "Right Lower Lobe", "Left Upper Lobe", "Left Lower Lobe"),
+    "Nodule Type": ("Solid", "Part-solid", "Ground-glass"),
+    "Confidence on Nodule Type": ("High", "Medium", "Low"),
+    "Comments on Nodule Type": ("Calcified", "Near the fissure"),
+    "Nodule Morphology": ("Round", "Lobulated", "Spiculated"),
+    "Confidence on Nodule Morphology": ("High", "Medium", "Low"),
+    "Comments on Nodule Morphology": ("Irregular margin",),
+    "Nodule-wise LungRADS Score": ("2 Benign appearance", "3 Probably benign", "4A Suspicious", "4B Very suspicious"),
+    "Confidence on LungRADS Score": ("High", "Medium", "Low"),
+    "Comments on LungRADS Score": ("Follow up in 6 months",),
+    "Nodule Suspicion Rank (1-5)": ("1", "2", "3", "4", "5"),
+    "Entity Comments": ("Reviewed twice",),
+}
+
+CLASSIFICATION_ATTRIBUTES = {
+    "Study Reviewed?": ("Yes", "No"),
+    "Case-wise LungRADS Score": ("1 Negative", "2 Benign appearance", "3 Probably benign", "4A Suspicious"),
+    "Confidence on LungRADS Score": ("High", "Medium", "Low"),
+    "Comments on LungRADS Score": ("Prior scan not available",),
+}
+
+CLINICIANS = tuple(f"clinician{index}@hospital.org" for index in range(12))
+STAGES = ("Label", "Review_1", "Consensus", "END", None)
+STATUSES = ("COMPLETED", "IN_PROGRESS", "SKIPPED", None)
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def timestamp(rng):
+    """An ISO timestamp somewhere in the year after EPOCH, with or without milliseconds"""
+    moment = EPOCH + timedelta(seconds=rng.randrange(365 * 24 * 3600), milliseconds=rng.randrange(1000))
+    return moment.isoformat(timespec=rng.choice(("seconds", "milliseconds")))
+
+
+def some_attributes(rng, choices, present=0.85):
+    """A random subset of the attributes, so some rows miss a column"""
+    return {name: rng.choice(values) for name, values in choices.items() if rng.random() < present}
+
+
+def series(rng, nodule_count):
+    """One series with landmarks3d, measurements and a dict, list, empty or absent segmentMap"""
+    landmarks = []
+    measurements = []
+    segments = [] if rng.random() < 0.4 else {}
+    for index in range(nodule_count):
+        group = f"group-{index}" if rng.random() < 0.9 else None
+        landmark = {"category": "Nodule", "group": group, "point": [rng.random(), rng.random(), rng.random()]}
+        if rng.random() < 0.95:
+            landmark["attributes"] = some_attributes(rng, NODULE_ATTRIBUTES)
+        landmarks.append(landmark)
+
+        for category in MEASUREMENT_CATEGORIES:
+            if rng.random() < 0.7:
+                measured_group = group if rng.random() < 0.9 else "unlinked"
+                measurements.append({"category": category, "group": measured_group, "length": rng.uniform(1, 30)})
+
+        if rng.random() < 0.75:
+            segment = {"category": "Nodule"}
+            if rng.random() < 0.95:
+                segment["group"] = group
+            if isinstance(segments, dict):
+                segments[str(index + 1)] = segment
+            else:
+                segments.append(segment)
+
+    result = {"landmarks3d": landmarks or rng.choice((None, [])), "measurements": measurements or None}
+    if rng.random() < 0.85:
+        result["segmentMap"] = segments
+    return result
+
+
+def annotation(rng, clinician):
+    """A superTruth or consensus task with zero to five nodules"""
+    result = {
+        "updatedBy": clinician if rng.random() < 0.9 else None,
+        "updatedAt": timestamp(rng),
+        "status": rng.choice(STATUSES),
+        "series": [series(rng, rng.choice((0, 0, 1, 1, 2, 3, 5)))],
+    }
+    if rng.random() < 0.9:
+        result["classification"] = {"attributes": some_attributes(rng, CLASSIFICATION_ATTRIBUTES, present=0.8)}
+    return result
+
+
+def generate_tasks(count, seed=0):
+    """Yield count synthetic export tasks, the same ones for the same seed"""
+    rng = random.Random(seed)
+    for index in range(count):
+        task = {
+            "taskId": f"task-{seed}-{index:07d}",
+            "name": f"LungRADS/series-{index:07d}.nii.gz",
+            "currentStageName": rng.choice(STAGES),
+            "status": rng.choice(STATUSES),
+            "updatedAt": timestamp(rng),
+            "superTruth": annotation(rng, rng.choice(CLINICIANS)) if rng.random() < 0.7 else None,
+        }
+        shape = rng.random()
+        if shape < 0.75:
+            task["consensusTasks"] = [annotation(rng, clinician) for clinician in rng.sample(CLINICIANS, 3)]
+        elif shape < 0.85:
+            task["consensusTasks"] = [annotation(rng, rng.choice(CLINICIANS))]
+        else:
+            task["consensusTasks"] = None
+        yield task
@@ -0,0 +1,91 @@
+"""
+Throughput and peak-memory benchmark of the transform stages on synthetic export tasks.
+
+Runs fully offline: the tasks come from synthetic_export.py and nothing touches Secret Manager,
+GCS or RedBrick. For every size it measures
+
+    archive  iterator_to_json writing the JSON Lines archive to a temporary directory
+    rows     check_if_task_has_consensus over every task, keeping the rows
+    report   recreate_new_dataframe, the full transform including flagging
+
+and prints tasks/s, rows/s and the peak memory traced by tracemalloc above the generated input.
+
+    python benchmarks/transform_throughput.py [--sizes 1000 10000 100000] [--seed 0] [--no-memory]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "handlers"))
+
+import main  # noqa: E402
+from synthetic_export import generate_tasks  # noqa: E402
+
+
+def run_archive(tasks):
+    """Write the archive and return the number of tasks written"""
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        return main.iterator_to_json(iter(tasks), directory, "tasks.jsonl")
+
+
+def run_rows(tasks):
+    """Build the report rows and return how many there are"""
+    return len(list(main.iter_report_rows(tasks)))
+
+
+def run_report(tasks):
+    """Build the flagged report dataframe and return its length"""
+    return len(main.recreate_new_dataframe(main.create_a_data_frame(tasks)))
+
+
+STAGES = (("archive", run_archive), ("rows", run_rows), ("report", run_report))
+
+
+def measure(stage, tasks, trace_memory):
+    """Return (seconds, items produced, peak traced bytes or None) of one stage run"""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    produced = stage(tasks)
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, produced, peak
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="task counts")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic export")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slower) tracemalloc pass")
+    args = parser.parse_args()
+
+    # Warm up the lazy imports so they are not charged to the first size.
+    for _, stage in STAGES:
+        stage(list(generate_tasks(10, seed=args.seed)))
+
+    print(f"{'tasks':>8} {'stage':<8} {'seconds':>9} {'tasks/s':>10} {'rows/s':>10} {'peak MiB':>9}")
+    for size in args.sizes:
+        tasks = list(generate_tasks(size, seed=args.seed))
+        row_count = run_rows(tasks)
+        for name, stage in STAGES:
+            # Throughput is timed without tracemalloc, which slows allocation-heavy code down.
+            seconds, _, _ = measure(stage, tasks, trace_memory=False)
+            peak = "-"
+            if not args.no_memory:
+                peak = f"{measure(stage, tasks, trace_memory=True)[2] / 2**20:.1f}"
+            print(
+                f"{size:>8} {name:<8} {seconds:>9.2f} {size / seconds:>10.0f} {row_count / seconds:>10.0f} {peak:>9}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -0,0 +1,101 @@
+"""Stage checkpoints and content-hash comparisons, so reruns skip work that is already done"""
+import base64
+import hashlib
+import json
+import logging
+import os
+
+# Retries of a Cloud Run execution share its name and resume from its checkpoint. Runs outside Cloud Run
+# always start over, so a manual rerun is never skipped as already done.
+RUN_ID = os.environ.get("CLOUD_RUN_EXECUTION")
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_md5(path):
+    """Base64 MD5 of a local file, in the form GCS reports as md5_hash"""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+
+def file_crc32c(path):
+    """Base64 CRC32C of a local file, in the form GCS reports as crc32c"""
+    import google_crc32c
+
+    checksum = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+def blob_matches_file(blob, path):
+    """
+    Whether an existing blob (with its metadata loaded) holds the same bytes as a local file.
+    Composite objects have no MD5, so they are compared by CRC32C.
+    """
+    if blob is None or blob.size != os.path.getsize(path):
+        return False
+    if blob.md5_hash:
+        return blob.md5_hash == file_md5(path)
+    return blob.crc32c == file_crc32c(path)
+
+
+def upload_if_changed(bucket, blob_name, path, content_type, previous_blob_name=None):
+    """
+    Upload a local file unless the blob already holds the same bytes; return whether it was uploaded.
+    When the blob previous_blob_name holds them instead, it is copied inside GCS.
+    """
+    if blob_matches_file(bucket.get_blob(blob_name), path):
+        logging.warning(f"gs://{bucket.name}/{blob_name} is unchanged, skipping the upload")
+        return False
+    if previous_blob_name and previous_blob_name != blob_name:
+        previous = bucket.get_blob(previous_blob_name)
+        if blob_matches_file(previous, path):
+            bucket.copy_blob(previous, bucket, blob_name)
+            logging.warning(f"gs://{bucket.name}/{blob_name} is unchanged since {previous_blob_name}, copied it")
+            return False
+    bucket.blob(blob_name).upload_from_filename(path, content_type=content_type)
+    return True
+
+
+class Checkpoint:
+    """
+    Completed stages of the current run of a project, kept as JSON in the output bucket.
+    The last uploaded archive and the inputs and outputs of the last successful publish are kept across runs.
+    """
+
+    def __init__(self, bucket, name):
+        self.blob = bucket.blob(f"checkpoints/{name}.json")
+        state = json.loads(self.blob.download_as_bytes()) if self.blob.exists() else {}
+        self.last_archive = state.get("last_archive")
+        self.last_publish = state.get("last_publish")
+        self.stages = state.get("stages", {}) if RUN_ID and state.get("run") == RUN_ID else {}
+        if self.stages:
+            logging.warning(f"Resuming {RUN_ID} from its checkpoint, finished stages: {', '.join(self.stages)}")
+
+    def done(self, stage):
+        """Whether the stage finished in this run"""
+        return stage in self.stages
+
+    def get(self, stage):
+        """What the stage recorded when it finished in this run"""
+        return self.stages[stage]
+
+    def complete(self, stage, **info):
+        """Record a finished stage; a finished archive or publish is also remembered for later runs"""
+        self.stages[stage] = info
+        if stage == "archive":
+            self.last_archive = info
+        elif stage == "publish":
+            self.last_publish = info
+        state = {
+            "run": RUN_ID,
+            "stages": self.stages,
+            "last_archive": self.last_archive,
+            "last_publish": self.last_publish,
+        }
+        self.blob.upload_from_string(json.dumps(state), content_type="application/json")
@@ -0,0 +1,56 @@
+"""Compression codecs of the archive and report blobs: none, gzip or zstd"""
+import gzip
+import os
+
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+CONTENT_TYPES = {"gzip": "application/gzip", "zstd": "application/zstd"}
+
+
+def extension(codec):
+    """File extension a codec adds; raises ValueError for an unknown codec"""
+    if codec not in EXTENSIONS:
+        raise ValueError(f"Unknown compression {codec!r}, expected one of {', '.join(EXTENSIONS)}")
+    return EXTENSIONS[codec]
+
+
+def zstandard():
+    """The optional zstandard module"""
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compression needs the zstandard package (pip install zstandard)") from e
+    return zstandard
+
+
+def open_compressed_writer(raw, codec):
+    """
+    Binary stream that compresses into raw while it is written. Closing it finishes the compressed
+    data without closing raw; with codec "none" raw itself is returned.
+    """
+    extension(codec)
+    if codec == "gzip":
+        # A fixed mtime keeps the output byte-identical for identical input, so hashes can be compared.
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    if codec == "zstd":
+        return zstandard().ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=False)
+    return raw
+
+
+def open_decompressed(stream):
+    """
+    Binary stream of the decompressed content of a seekable stream holding gzip, zstd or uncompressed
+    data, told apart by their magic bytes. Concatenated gzip members or zstd frames read as one stream.
+    """
+    magic = stream.read(4)
+    stream.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if magic == ZSTD_MAGIC:
+        return zstandard().ZstdDecompressor().stream_reader(stream, read_across_frames=True, closefd=False)
+    return stream
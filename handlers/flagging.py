@@ -0,0 +1,101 @@
+"""QC flags computed over the whole report table at once"""
+import numpy as np
+import pandas as pd
+from report_schema import INTERNAL_COLUMNS, MISSING, NO_NODULE_ROW, NODULE_ROW
+
+REQUIRED_NODULE_COLUMNS = [
+    "Nodule Location",
+    "Nodule Type",
+    "Confidence on Nodule Type",
+    "Nodule Morphology",
+    "Confidence on Nodule Morphology",
+    "Nodule-wise LungRADS Score",
+    "Confidence on LungRADS Score",
+]
+REQUIRED_CLASSIFICATION_COLUMNS = [
+    "Classification (Study Reviewed?)",
+    "Classification (Case-wise LungRADS Score)",
+    "Classification (Confidence on LungRADS Score)",
+]
+PART_SOLID_COLUMNS = [
+    "Nodule Core 2D Mean Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Max Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Min Diameter (Only for part-solid nodules)",
+]
+VOLUME_COLUMNS = [
+    "Nodule Volume 2D Mean Diameter",
+    "Nodule Volume 2D Max Diameter",
+    "Nodule Volume 2D Min Diameter",
+]
+
+# (flag, row kind, rule) in the order flags are appended to "Flagged".
+# Rules take the masks built by flag_masks and return a boolean Series.
+FLAG_RULES = (
+    ("Unnecessary Rank", NODULE_ROW, lambda m: ~m["located"] & m["ranked"]),
+    ("Missing Attributes", NODULE_ROW, lambda m: m["located"] & m["missing_attributes"]),
+    ("Missing Classifications", NODULE_ROW, lambda m: m["missing_classifications"]),
+    ("Missing Part-solid Data", NODULE_ROW, lambda m: m["part_solid"] & m["missing_part_solid"]),
+    ("Missing Measure of Center", NODULE_ROW, lambda m: m["located"] & m["missing_volume"]),
+    ("Volume not Linked", NODULE_ROW, lambda m: m["located"] & ~m["volume_linked"]),
+    ("LungRADS Score Mismatch", NODULE_ROW, lambda m: m["rank_one"] & m["score_mismatch"]),
+    ("Missing Nodule Location", NODULE_ROW, lambda m: ~m["located"]),
+    # Rank checks, evaluated per annotation (Task ID + Annotation)
+    ("Missing Rank", NODULE_ROW, lambda m: m["located"] & ~m["ranked"] & (m["unique_ranks"] != 5)),
+    ("Duplicate Ranks", NODULE_ROW, lambda m: m["located"] & m["ranked"] & (m["rank_count"] != m["unique_ranks"])),
+    (
+        "Missing Rank",
+        NODULE_ROW,
+        lambda m: (m["ranked_located"] > 0) & (m["unique_ranks"] > 0) & (m["ranked_located"] != m["max_rank"]),
+    ),
+    ("Missing Classifications", NO_NODULE_ROW, lambda m: m["study_not_reviewed"]),
+)
+
+
+def first_word(column):
+    """First space-separated word of every value in a column"""
+    return column.astype(str).str.split(" ", n=1).str[0]
+
+
+def flag_masks(frame):
+    """Boolean columns shared by the flag rules, including the per-annotation rank statistics"""
+    rank = frame["Nodule Suspicion Rank (1-5)"]
+    nodule = frame["Row Kind"] == NODULE_ROW
+    located = frame["Nodule Location"] != MISSING
+    ranked = (rank != MISSING) & nodule
+
+    rank_values = pd.Series(np.nan, index=frame.index)
+    rank_values[ranked] = rank[ranked].astype(int)
+    annotation = [frame["Task ID"], frame["Annotation"]]
+
+    return {
+        "located": located,
+        "ranked": ranked,
+        "missing_attributes": frame[REQUIRED_NODULE_COLUMNS].eq(MISSING).any(axis=1),
+        "missing_classifications": frame[REQUIRED_CLASSIFICATION_COLUMNS].eq(MISSING).any(axis=1),
+        "part_solid": frame["Nodule Type"] == "Part-solid",
+        "missing_part_solid": frame[PART_SOLID_COLUMNS].eq(MISSING).any(axis=1),
+        "missing_volume": frame[VOLUME_COLUMNS].eq(MISSING).any(axis=1),
+        "volume_linked": frame["Volume Linked"].astype(bool),
+        "rank_one": rank == "1",
+        "score_mismatch": first_word(frame["Classification (Case-wise LungRADS Score)"])
+        != first_word(frame["Nodule-wise LungRADS Score"]),
+        "study_not_reviewed": frame["Classification (Study Reviewed?)"] == MISSING,
+        "rank_count": ranked.groupby(annotation, sort=False).transform("sum"),
+        "ranked_located": (ranked & located).groupby(annotation, sort=False).transform("sum"),
+        "unique_ranks": rank_values.groupby(annotation, sort=False).transform("nunique"),
+        "max_rank": rank_values.groupby(annotation, sort=False).transform("max"),
+    }
+
+
+def flag_report(frame):
+    """Fill "Flagged" for every row of the report table and drop the bookkeeping columns"""
+    flagged = np.full(len(frame), "", dtype=object)
+    if len(frame):
+        masks = flag_masks(frame)
+        kind = frame["Row Kind"]
+        for flag, row_kind, rule in FLAG_RULES:
+            mask = ((kind == row_kind) & rule(masks)).to_numpy()
+            flagged[mask] = flagged[mask] + f"{flag},"
+
+    frame["Flagged"] = flagged
+    return frame.drop(columns=list(INTERNAL_COLUMNS))
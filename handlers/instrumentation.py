@@ -0,0 +1,146 @@
+"""Per-stage timing, counters and memory of the daily job, logged as structured JSON"""
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Name of a stage to run under cProfile (e.g. "publish"); its stats are dumped to PROFILE_DIR.
+PROFILE_STAGE = os.environ.get("PROFILE_STAGE")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", tempfile.gettempdir())
+
+
+_local = threading.local()
+
+
+class StageThreads:
+    """
+    CPU time and profiles of the threads working for one stage: the thread that runs it and the
+    pipeline threads producing its input, which attach themselves through overlapped.
+    """
+
+    def __init__(self, profile, parent=None):
+        self.profile = profile
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.cpu_seconds = 0.0
+        self.profilers = []
+
+    def chain(self):
+        """This stage and the stages it runs inside of"""
+        run = self
+        while run is not None:
+            yield run
+            run = run.parent
+
+    @contextmanager
+    def attach(self, inherited=True):
+        """
+        Count the calling thread's CPU time towards the stage, profiling it when the stage is profiled.
+        A pipeline thread (inherited) also counts towards the enclosing stages, whose own threads are
+        busy waiting for it; the thread running a stage is measured by each stage it enters.
+        """
+        runs = list(self.chain()) if inherited else [self]
+        profiled = [run for run in runs if run.profile]
+        profiler = None
+        if profiled:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        previous = getattr(_local, "stage", None)
+        _local.stage = self
+        start = time.thread_time()
+        try:
+            yield
+        finally:
+            elapsed = time.thread_time() - start
+            _local.stage = previous
+            if profiler:
+                profiler.disable()
+            for run in runs:
+                with run.lock:
+                    run.cpu_seconds += elapsed
+                    if run in profiled:
+                        run.profilers.append(profiler)
+
+
+def current_stage():
+    """The stage the calling thread works for, for the pipeline threads it starts to attach to"""
+    return getattr(_local, "stage", None)
+
+
+def peak_rss_mb():
+    """High-water mark of this process' resident memory in MiB (ru_maxrss is in KiB on Linux)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def log_record(record):
+    """Write one JSON log line; Cloud Logging turns it into a structured entry"""
+    print(json.dumps(record, default=str), file=sys.stdout, flush=True)
+
+
+@contextmanager
+def stage(name, project=None):
+    """
+    Measure one stage of the job and log it when the block exits.
+    The block receives a dict to record its own counters in (tasks, rows, bytes, ...).
+    cpu_seconds is the CPU time of the calling thread and of the overlapped pipeline threads feeding
+    it (not of transform worker processes), so projects running side by side do not inflate each
+    other's numbers. The profile of PROFILE_STAGE covers the same threads.
+    """
+    metrics = {}
+    threads = StageThreads(PROFILE_STAGE == name, parent=current_stage())
+
+    status = "ok"
+    wall_start = time.perf_counter()
+    try:
+        with threads.attach(inherited=False):
+            yield metrics
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        # Pipeline threads have been joined by now, so every thread of the stage has reported in.
+        timings = {
+            "wall_seconds": round(time.perf_counter() - wall_start, 3),
+            "cpu_seconds": round(threads.cpu_seconds, 3),
+        }
+        if threads.profilers:
+            prefix = f"{project['name']}-" if project else ""
+            timings["profile"] = os.path.join(PROFILE_DIR, f"{prefix}{name}.prof")
+            pstats.Stats(*threads.profilers).dump_stats(timings["profile"])
+        log_stage(name, project, {**timings, **metrics}, status)
+
+
+def log_stage(name, project, metrics, status="ok"):
+    """Log the record of a stage; also used for stages measured piecewise, such as a streamed export"""
+    log_record(
+        {
+            "severity": "INFO" if status == "ok" else "ERROR",
+            "message": f"stage {name} {'finished' if status == 'ok' else 'failed'}",
+            "stage": name,
+            "project": project["name"] if project else None,
+            "status": status,
+            **metrics,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+
+
+def timed(iterable, metrics, key):
+    """Yield from iterable, adding the seconds spent producing its items to metrics[key]"""
+    metrics.setdefault(key, 0.0)
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics[key] = round(metrics[key] + time.perf_counter() - start, 3)
+            return
+        metrics[key] += time.perf_counter() - start
+        yield item
@@ -1,16 +1,54 @@
+import csv
+import hashlib
 import logging
+import multiprocessing
 import subprocess
 import io
 import json
 import os
-import pandas as pd
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
 from datetime import date, datetime
-from google.cloud import secretmanager, storage
-import redbrick
+from itertools import chain, islice
+from report_schema import (
+    ANNOTATION,
+    CATEGORICAL_COLUMNS,
+    CLASSIFICATION_ATTRIBUTE_COLUMNS,
+    CLINICIAN_NAME,
+    COLUMNS,
+    MEASUREMENT_COLUMNS,
+    MISSING,
+    NAME,
+    NO_NODULE_ROW,
+    NODULE_ATTRIBUTE_COLUMNS,
+    NODULE_CENTROID,
+    NODULE_LOCATION,
+    NODULE_ROW,
+    ROW_COLUMNS,
+    ROW_KIND,
+    SEGMENT_PATH,
+    SERIES_SEGMENT_PATH,
+    STAGE,
+    STATUS,
+    TASK_ID,
+    UPDATED_AT,
+    VOLUME_LINKED,
+    new_row,
+)
+from compression import CONTENT_TYPES, extension, open_compressed_writer, open_decompressed
+from instrumentation import log_stage, stage, timed
+from pipeline import overlapped
+from project_registry import load_projects
+from secret_store import get_secret, get_secrets
+from task_reader import iter_tasks
 
 
 def create_a_data_frame(file):
     """This will create a DataFrame for JSON"""
+    import pandas as pd
+
     if not file:
         return pd.DataFrame()
 
@@ -22,138 +60,47 @@ def create_a_data_frame(file):
         return pd.DataFrame()
 
 
-def check_rank(rank, datas):
-    """Checks duplicates in Ranks"""
-    new_rank = []
-    for r in rank:
-        if r != "----":
-            new_rank.append(int(r))
-    sets = list(set(new_rank))
-    flagged = ""
-    if len(new_rank) != len(sets):
-        flagged = "Duplicate Ranks,"
-    if len(new_rank) == 0:
-        flagged = "Missing Attributes,"
-
-    count = 0
-    for data in datas:
-        if data["Nodule Location"] != "----":
-            if data["Nodule Suspicion Rank (1-5)"] == "----" and len(sets) != 5:
-                data["Flagged"] += "Missing Rank,"
-
-            if data["Nodule Suspicion Rank (1-5)"] != "----":
-                count += 1
-                data["Flagged"] += flagged
-
-    for data in datas:
-        if count > 0 and len(sets) > 0:
-            if count != sets[-1]:
-                data["Flagged"] += "Missing Rank,"
-
-
 def data_values():
     """The values needed to create a row"""
-    data = {}
-    data["Task ID"] = "----"
-    data["Name"] = "----"
-    data["Clinician Name"] = "----"
-    data["Updated At"] = "----"
-    data["Status"] = "----"
-    data["Stage"] = "----"
-    data["Nodule Centroid"] = "----"
-    data["Nodule Location"] = "----"
-    data["Nodule Type"] = "----"
-    data["Confidence on Nodule Type"] = "----"
-    data["Comments on Nodule Type"] = "----"
-    data["Nodule Morphology"] = "----"
-    data["Confidence on Nodule Morphology"] = "----"
-    data["Comments on Nodule Morphology"] = "----"
-    data["Nodule-wise LungRADS Score"] = "----"
-    data["Confidence on LungRADS Score"] = "----"
-    data["Comments on LungRADS Score"] = "----"
-    data["Nodule Suspicion Rank (1-5)"] = "----"
-    data["Entity Comments"] = "----"
-    data["Nodule Volume 2D Mean Diameter"] = "----"
-    data["Nodule Volume 2D Max Diameter"] = "----"
-    data["Nodule Volume 2D Min Diameter"] = "----"
-    data["Nodule Core 2D Mean Diameter (Only for part-solid nodules)"] = "----"
-    data["Nodule Core 2D Max Diameter (Only for part-solid nodules)"] = "----"
-    data["Nodule Core 2D Min Diameter (Only for part-solid nodules)"] = "----"
-    data["Classification (Study Reviewed?)"] = "----"
-    data["Classification (Case-wise LungRADS Score)"] = "----"
-    data["Classification (Confidence on LungRADS Score)"] = "----"
-    data["Classification (Comments on LungRADS Score)"] = "----"
-    data["Segment path"] = "----"
-    data["Flagged"] = ""
-    return data
+    return new_row()
 
 
-def check_data_to_be_flagged(data, groups):
-    """Check if Data has something to be flagged"""
-    attributes = [
-        data["Nodule Location"],
-        data["Nodule Type"],
-        data["Confidence on Nodule Type"],
-        data["Nodule Morphology"],
-        data["Confidence on Nodule Morphology"],
-        data["Nodule-wise LungRADS Score"],
-        data["Confidence on LungRADS Score"],
-    ]
-    classification = [
-        data["Classification (Study Reviewed?)"],
-        data["Classification (Case-wise LungRADS Score)"],
-        data["Classification (Confidence on LungRADS Score)"],
-    ]
-
-    part_solid = [
-        data["Nodule Core 2D Mean Diameter (Only for part-solid nodules)"],
-        data["Nodule Core 2D Max Diameter (Only for part-solid nodules)"],
-        data["Nodule Core 2D Min Diameter (Only for part-solid nodules)"],
-    ]
-
-    static = [
-        data["Nodule Volume 2D Mean Diameter"],
-        data["Nodule Volume 2D Max Diameter"],
-        data["Nodule Volume 2D Min Diameter"],
-    ]
-
-    if data["Nodule Location"] == "----" and data["Nodule Suspicion Rank (1-5)"] != "----":
-        data["Flagged"] += "Unnecessary Rank,"
-
-    if "----" in attributes and data["Nodule Location"] != "----":
-        data["Flagged"] += "Missing Attributes,"
-
-    if "----" in classification:
-        data["Flagged"] += "Missing Classifications,"
-
-    if data["Nodule Type"] == "Part-solid":
-        if "----" in part_solid:
-            data["Flagged"] += "Missing Part-solid Data,"
-
-    if data["Nodule Location"] != "----":
-        if "----" in static:
-            data["Flagged"] += "Missing Measure of Center,"
-
-        if not groups:
-            data["Flagged"] += "Volume not Linked,"
-
-    if data["Nodule Suspicion Rank (1-5)"] == "1":
-        if data["Classification (Case-wise LungRADS Score)"].split(" ")[0] != data["Nodule-wise LungRADS Score"].split(" ")[0]:
-            data["Flagged"] += "LungRADS Score Mismatch,"
+def fill_task_columns(data, row, task):
+    """Fill the task, clinician, date, stage and status columns of a row"""
+    data[TASK_ID] = row["taskId"]
+    data[NAME] = row["name"]
+    if task.get("updatedBy"):
+        data[CLINICIAN_NAME] = sys.intern(task.get("updatedBy"))
+    if task.get("updatedAt"):
+        date = datetime.fromisoformat(task.get("updatedAt"))
+        formatted_str = date.strftime("%Y:%m:%d %H:%M:%S")
+        data[UPDATED_AT] = formatted_str
+    if row.get("currentStageName"):
+        data[STAGE] = sys.intern(row.get("currentStageName"))
+    if task.get("status"):
+        data[STATUS] = sys.intern(task.get("status"))
 
-    return data
+
+def fill_classification_columns(data, classification):
+    """Fill the study classification columns of a row"""
+    if classification:
+        attributes = classification.get("attributes")
+        if attributes:
+            for attribute, column in CLASSIFICATION_ATTRIBUTE_COLUMNS:
+                if attributes.get(attribute):
+                    data[column] = attributes.get(attribute)
 
 
 def empty_data(row):
     """This will get the data for no nodules"""
     rows = []
     data = data_values()
-    data["Task ID"] = row["taskId"]
-    data["Name"] = row["name"]
+    data[TASK_ID] = row["taskId"]
+    data[NAME] = row["name"]
     if row.get("currentStageName"):
-        data["Stage"] = row.get("currentStageName")
+        data[STAGE] = row.get("currentStageName")
     if row.get("status"):
-        data["Stage"] = row.get("currentStageName")
+        data[STAGE] = row.get("currentStageName")
     rows.append(data)
     return rows
 
@@ -162,67 +109,22 @@ def empty_consensus(row, task, data):
     """This will get the data for no nodules"""
     rows = []
     data = data_values()
-    data["Task ID"] = row["taskId"]
-    data["Name"] = row["name"]
-    if task.get("updatedBy"):
-        data["Clinician Name"] = task.get("updatedBy")
-    if task.get("updatedAt"):
-        date = datetime.fromisoformat(task.get("updatedAt"))
-        formatted_str = date.strftime("%Y:%m:%d %H:%M:%S")
-        data["Updated At"] = formatted_str
-    if row.get("currentStageName"):
-        data["Stage"] = row.get("currentStageName")
-    if task.get("status"):
-        data["Status"] = task.get("status")
+    fill_task_columns(data, row, task)
     rows.append(data)
     return rows
 
 
-def check_data_to_be_flagged_for_no_nodule(data):
-    """Check data to be flagged"""
-    data["Classification (Study Reviewed?)"]
-
-    if data["Classification (Study Reviewed?)"] == "----":
-        data["Flagged"] += "Missing Classifications,"
-
-    return data
-
-
-def no_nodule(row, task, classification, data, segment_path):
+def no_nodule(row, task, classification, data, series_index):
     """Data from No Consensus"""
     rows = []
-    normalized_segments = normalize_segment_entries(segment_path)
-    if normalized_segments:
-        data["Segment Path"] = "Yes"
+    if series_index["segment_groups"]:
+        data[SERIES_SEGMENT_PATH] = "Yes"
     else:
-        data["Segment Path"] = "No path available"
-    data["Task ID"] = row["taskId"]
-    data["Name"] = row["name"]
-    if task.get("updatedBy"):
-        data["Clinician Name"] = task.get("updatedBy")
-    if task.get("updatedAt"):
-        date = datetime.fromisoformat(task.get("updatedAt"))
-        formatted_str = date.strftime("%Y:%m:%d %H:%M:%S")
-        data["Updated At"] = formatted_str
-    if row.get("currentStageName"):
-        data["Stage"] = row.get("currentStageName")
-    if task.get("status"):
-        data["Status"] = task.get("status")
-
-    if classification:
-        attributes = classification.get("attributes")
-        if attributes:
-            if attributes.get("Study Reviewed?"):
-                data["Classification (Study Reviewed?)"] = attributes.get("Study Reviewed?")
-            if attributes.get("Case-wise LungRADS Score"):
-                data["Classification (Case-wise LungRADS Score)"] = attributes.get("Case-wise LungRADS Score")
-            if attributes.get("Confidence on LungRADS Score"):
-                data["Classification (Confidence on LungRADS Score)"] = attributes.get("Confidence on LungRADS Score")
-            if attributes.get("Comments on LungRADS Score"):
-                data["Classification (Comments on LungRADS Score)"] = attributes.get("Comments on LungRADS Score")
-
-    flagged_data = check_data_to_be_flagged_for_no_nodule(data)
-    rows.append(flagged_data)
+        data[SERIES_SEGMENT_PATH] = "No path available"
+    data[ROW_KIND] = NO_NODULE_ROW
+    fill_task_columns(data, row, task)
+    fill_classification_columns(data, classification)
+    rows.append(data)
     return rows
 
 
@@ -237,115 +139,84 @@ def normalize_segment_entries(segment_map):
     return []
 
 
-def check_nodule_segment_path(data, segment_path):
+def index_series(series):
+    """
+    Index a series once so every nodule can be filled with dict lookups.
+    measurements maps group -> {column: rounded length}, segment_groups holds the segmentMap
+    groups and volume_linked is False when any segmentMap entry has no group.
+    """
+    measurements = {}
+    for volume in series.get("measurements") or []:
+        group = volume.get("group")
+        column = MEASUREMENT_COLUMNS.get(volume.get("category"))
+        if group and column is not None:
+            measurements.setdefault(group, {})[column] = round(volume["length"], 4)
+
+    segments = normalize_segment_entries(series.get("segmentMap"))
+    return {
+        "measurements": measurements,
+        "segment_groups": {segment.get("group") for segment in segments},
+        "volume_linked": all(segment.get("group") for segment in segments),
+    }
+
+
+def check_nodule_segment_path(data, segment_groups):
     """Check whether current nodule group exists in segmentMap."""
-    if data["Nodule Location"] == "----":
-        data["Flagged"] += "Missing Nodule Location,"
+    if data[NODULE_LOCATION] == MISSING:
         return data
 
-    data["Segment path"] = "No"
-    nodule_group = data["Nodule Centroid"]
-    for segment in normalize_segment_entries(segment_path):
-        if segment.get("group") == nodule_group:
-            data["Segment path"] = "Yes"
-            break
+    if data[NODULE_CENTROID] in segment_groups:
+        data[SEGMENT_PATH] = "Yes"
+    else:
+        data[SEGMENT_PATH] = "No"
     return data
 
 
-def get_task_data(row, task, nodule, volume_measures, groups, maps, classification, data, segment_path):
+def get_task_data(row, task, nodule, series_index, classification, data):
     """Data from Super Task"""
     rows = []
-    data["Task ID"] = row["taskId"]
-    data["Name"] = row["name"]
-    if task.get("updatedBy"):
-        data["Clinician Name"] = task.get("updatedBy")
-    if task.get("updatedAt"):
-        date = datetime.fromisoformat(task.get("updatedAt"))
-        formatted_str = date.strftime("%Y:%m:%d %H:%M:%S")
-        data["Updated At"] = formatted_str
-    if row.get("currentStageName"):
-        data["Stage"] = row.get("currentStageName")
-    if task.get("status"):
-        data["Status"] = task.get("status")
+    data[ROW_KIND] = NODULE_ROW
+    data[VOLUME_LINKED] = series_index["volume_linked"]
+    fill_task_columns(data, row, task)
     if nodule.get("group"):
-        data["Nodule Centroid"] = nodule.get("group")
+        data[NODULE_CENTROID] = nodule.get("group")
     if nodule.get("attributes"):
         attributes = nodule.get("attributes")
-        if attributes.get("Nodule Location"):
-            data["Nodule Location"] = attributes.get("Nodule Location")
-        if attributes.get("Nodule Type"):
-            data["Nodule Type"] = attributes.get("Nodule Type")
-        if attributes.get("Confidence on Nodule Type"):
-            data["Confidence on Nodule Type"] = attributes.get("Confidence on Nodule Type")
-        if attributes.get("Comments on Nodule Type"):
-            data["Comments on Nodule Type"] = attributes.get("Comments on Nodule Type")
-        if attributes.get("Nodule Morphology"):
-            data["Nodule Morphology"] = attributes.get("Nodule Morphology")
-        if attributes.get("Confidence on Nodule Morphology"):
-            data["Confidence on Nodule Morphology"] = attributes.get("Confidence on Nodule Morphology")
-        if attributes.get("Comments on Nodule Morphology"):
-            data["Comments on Nodule Morphology"] = attributes.get("Comments on Nodule Morphology")
-        if attributes.get("Nodule-wise LungRADS Score"):
-            data["Nodule-wise LungRADS Score"] = attributes.get("Nodule-wise LungRADS Score")
-        if attributes.get("Confidence on LungRADS Score"):
-            data["Confidence on LungRADS Score"] = attributes.get("Confidence on LungRADS Score")
-        if attributes.get("Comments on LungRADS Score"):
-            data["Comments on LungRADS Score"] = attributes.get("Comments on LungRADS Score")
-        if attributes.get("Nodule Suspicion Rank (1-5)"):
-            data["Nodule Suspicion Rank (1-5)"] = attributes.get("Nodule Suspicion Rank (1-5)")
-        if attributes.get("Entity Comments"):
-            data["Entity Comments"] = attributes.get("Entity Comments")
-        if (volume_measures) and (volume_measures != 0):
-            group = nodule.get("group")
-            for volume in volume_measures:
-                if volume.get("group") and volume["group"] == group:
-                    if volume["category"] == "Nodule Volume 2D Min Diameter":
-                        data["Nodule Volume 2D Min Diameter"] = round(volume["length"], 4)
-                    if volume["category"] == "Nodule Volume 2D Max Diameter":
-                        data["Nodule Volume 2D Max Diameter"] = round(volume["length"], 4)
-                    if volume["category"] == "Nodule Volume 2D Mean Diameter":
-                        data["Nodule Volume 2D Mean Diameter"] = round(volume["length"], 4)
-                    if volume["category"] == "Nodule Core 2D Min Diameter (Only for part-solid nodules)":
-                        data["Nodule Core 2D Min Diameter (Only for part-solid nodules)"] = round(volume["length"], 4)
-                    if volume["category"] == "Nodule Core 2D Max Diameter (Only for part-solid nodules)":
-                        data["Nodule Core 2D Max Diameter (Only for part-solid nodules)"] = round(volume["length"], 4)
-                    if volume["category"] == "Nodule Core 2D Mean Diameter (Only for part-solid nodules)":
-                        data["Nodule Core 2D Mean Diameter (Only for part-solid nodules)"] = round(volume["length"], 4)
+        for attribute, column in NODULE_ATTRIBUTE_COLUMNS:
+            if attributes.get(attribute):
+                data[column] = attributes.get(attribute)
+        measurements = series_index["measurements"].get(nodule.get("group"))
+        if measurements:
+            for column, length in measurements.items():
+                data[column] = length
 
-    if classification:
-        attributes = classification.get("attributes")
-        if attributes:
-            if attributes.get("Study Reviewed?"):
-                data["Classification (Study Reviewed?)"] = attributes.get("Study Reviewed?")
-            if attributes.get("Case-wise LungRADS Score"):
-                data["Classification (Case-wise LungRADS Score)"] = attributes.get("Case-wise LungRADS Score")
-            if attributes.get("Confidence on LungRADS Score"):
-                data["Classification (Confidence on LungRADS Score)"] = attributes.get("Confidence on LungRADS Score")
-            if attributes.get("Comments on LungRADS Score"):
-                data["Classification (Comments on LungRADS Score)"] = attributes.get("Comments on LungRADS Score")
-
-    flagged_data = check_data_to_be_flagged(data, groups)
-    flagged_data = check_nodule_segment_path(flagged_data, segment_path)
-    rows.append(flagged_data)
+    fill_classification_columns(data, classification)
+
+    rows.append(check_nodule_segment_path(data, series_index["segment_groups"]))
     return rows
 
 
-def return_a_list_of_groups(maps):
-    """Create a sorted list of GroupID"""
-    if maps:
-        list_of_groups = []
-        count = 0
-        for value in maps.values():
-            group = value.get("group")
-            count += 1
-            if group:
-                list_of_groups.append(group)
-        if count != len(list_of_groups):
-            return False
-        else:
-            return "----"
+def annotation_rows(row, task, annotation):
+    """
+    Rows for one annotation (0 for the superTruth, 1-3 for the consensus tasks) of a task.
+    The annotation number groups the rows for the rank checks in the flagging stage.
+    """
+    series_index = index_series(task["series"][0])
+    nodules = task["series"][0].get("landmarks3d")
+    classification = task.get("classification")
+
+    rows = []
+    if nodules and nodules != 0:
+        for nodule in nodules:
+            data = data_values()
+            rows.extend(get_task_data(row, task, nodule, series_index, classification, data))
     else:
-        return "----"
+        data = data_values()
+        rows.extend(no_nodule(row, task, classification, data, series_index))
+
+    for data in rows:
+        data[ANNOTATION] = annotation
+    return rows
 
 
 def check_if_task_has_consensus(row):
@@ -353,240 +224,889 @@ def check_if_task_has_consensus(row):
     super_truth = row.get("superTruth")
     consensus = row.get("consensusTasks")
     rows = []
-    data = data_values()
 
     if super_truth and type(super_truth) != float:
-        nodules = super_truth["series"][0].get("landmarks3d")
-        volume_measures = super_truth["series"][0].get("measurements")
-        maps = super_truth["series"][0].get("segmentMap", None)
-        groups = return_a_list_of_groups(maps)
-        segment_path = super_truth["series"][0].get("segmentMap", None)
-        normalized_segments = normalize_segment_entries(segment_path)
-        if normalized_segments:
-            data["Segment Path"] = "Yes"
-        else:
-            data["Segment Path"] = "No path available"
-
-        classification = super_truth.get("classification")
-
-        if nodules and nodules != 0:
-            nodule_rows = []
-            ranks = []
-            datas = []
-            for nodule in nodules:
-                data = data_values()
-                datas = get_task_data(
-                    row, super_truth, nodule, volume_measures, groups, maps, classification, data, segment_path
-                )
-                ranks.append(datas[0]["Nodule Suspicion Rank (1-5)"])
-                nodule_rows.extend(datas)
-            check_rank(ranks, nodule_rows)
-            rows.extend(nodule_rows)
-
-        else:
-            data = data_values()
-            datas = no_nodule(row, super_truth, classification, data, segment_path)
-            rows.extend(datas)
+        rows.extend(annotation_rows(row, super_truth, 0))
 
     if consensus and len(consensus) == 3:
-        for task in consensus:
-            nodules = task["series"][0].get("landmarks3d")
-            volume_measures = task["series"][0].get("measurements")
-            classification = task.get("classification")
-            maps = task["series"][0].get("segmentMap", None)
-            groups = return_a_list_of_groups(maps)
-            segment_path = task["series"][0].get("segmentMap", None)
-            normalized_segments = normalize_segment_entries(segment_path)
-            if normalized_segments:
-                data["Segment Path"] = "Yes"
-            else:
-                data["Segment Path"] = "No path available"
-
-            if nodules and nodules != 0:
-                nodule_rows = []
-                ranks = []  
-                datas = []
-                for nodule in nodules:
-                    data = data_values()
-                    datas = get_task_data(
-                        row, task, nodule, volume_measures, groups, maps, classification, data, segment_path    
-                    )
-                    ranks.append(datas[0]["Nodule Suspicion Rank (1-5)"])
-                    nodule_rows.extend(datas)
-                check_rank(ranks, nodule_rows)
-                rows.extend(nodule_rows)
-
-            else:
-                data = data_values()
-                datas = no_nodule(row, task, classification, data, segment_path)
-                rows.extend(datas)
+        for annotation, task in enumerate(consensus, start=1):
+            # The report has always stamped the previous row's "Segment Path" with this
+            # consensus task's segmentMap; kept so existing reports stay comparable.
+            if rows:
+                has_segments = bool(normalize_segment_entries(task["series"][0].get("segmentMap")))
+                rows[-1][SERIES_SEGMENT_PATH] = "Yes" if has_segments else "No path available"
+            rows.extend(annotation_rows(row, task, annotation))
     else:
         datas = empty_data(row)
         rows.extend(datas)
-    return pd.DataFrame(rows)
+    return rows
+
+
+def iter_report_rows(tasks):
+    """Yield the report rows of every task, one schema-ordered list per row"""
+    for task in tasks:
+        yield from check_if_task_has_consensus(task)
+
+
+def build_report_frame(rows):
+    """
+    Build the flagged report dataframe from schema rows, with the repetitive columns as categoricals.
+    """
+    import pandas as pd
+    from flagging import flag_report
+
+    frame = flag_report(pd.DataFrame.from_records(rows, columns=list(ROW_COLUMNS)))
+    for column in CATEGORICAL_COLUMNS:
+        frame[column] = frame[column].astype("category")
+    return frame
+
+
+TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", "1"))
+TRANSFORM_CHUNK_SIZE = int(os.environ.get("TRANSFORM_CHUNK_SIZE", "500"))
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def transform_chunk(tasks):
+    """The rows of each task in a chunk, run inside a transform worker process"""
+    return [check_if_task_has_consensus(task) for task in tasks]
+
+
+def iter_transformed_chunks_parallel(chunks, workers):
+    """
+    Transform chunks of tasks on a process pool, yielding each chunk's rows per task in the original order.
+    At most two chunks per worker are in flight, so a streamed export is never read ahead in full.
+    """
+    # Spawned rather than forked workers: projects run on threads, and forking a threaded process can deadlock.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(transform_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_transformed_chunks(chunks, workers=TRANSFORM_WORKERS):
+    """Yield the rows per task of every chunk, transformed in parallel when workers > 1"""
+    if workers > 1:
+        yield from iter_transformed_chunks_parallel(chunks, workers)
+    else:
+        for chunk in chunks:
+            yield transform_chunk(chunk)
+
+
+def iter_cached_row_chunks(chunks, workers, cache):
+    """
+    Yield the rows of every chunk, taking unchanged tasks from the row cache and transforming only the rest.
+    Cache lookups and stores happen in this process; the workers only see the changed tasks.
+    """
+    lookups = deque()
+
+    def changed_tasks():
+        for chunk in chunks:
+            found = cache.lookup(chunk)
+            lookups.append((chunk, found))
+            yield [task for task, (_, task_rows) in zip(chunk, found) if task_rows is None]
+
+    for transformed in iter_transformed_chunks(changed_tasks(), workers):
+        chunk, found = lookups.popleft()
+        transformed = iter(transformed)
+        rows = []
+        for task, (key, task_rows) in zip(chunk, found):
+            if task_rows is None:
+                task_rows = next(transformed)
+                cache.store(task, key, task_rows)
+            rows.extend(task_rows)
+        yield rows
+
+
+def iter_row_chunks(tasks, workers=TRANSFORM_WORKERS, chunk_size=TRANSFORM_CHUNK_SIZE, cache=None):
+    """Yield the rows of every chunk_size tasks, transformed in parallel when workers > 1"""
+    chunks = chunked(tasks, chunk_size)
+    if cache is not None:
+        yield from iter_cached_row_chunks(chunks, workers, cache)
+        return
+    for transformed in iter_transformed_chunks(chunks, workers):
+        yield [row for task_rows in transformed for row in task_rows]
+
+
+def iter_report_frames(tasks, workers=TRANSFORM_WORKERS, chunk_size=TRANSFORM_CHUNK_SIZE, cache=None):
+    """
+    Yield flagged report frames of chunk_size tasks each, reusing cached rows of unchanged tasks.
+    A task's rows never span two frames, so every frame can be flagged on its own.
+    """
+    for rows in iter_row_chunks(tasks, workers, chunk_size, cache):
+        yield build_report_frame(rows)
 
 
 def recreate_new_dataframe(df):
     """Recreate a new dataframe"""
-    row = pd.concat(df.apply(check_if_task_has_consensus, axis=1).tolist(), ignore_index=True)
-    return row
+    return transform_tasks(df.to_dict("records"))
+
+
+def transform_tasks(tasks, workers=TRANSFORM_WORKERS):
+    """Transform an iterable of task dicts into the report dataframe, in parallel when workers > 1"""
+    rows = [row for chunk in iter_row_chunks(tasks, workers) for row in chunk]
+    return build_report_frame(rows)
+
+
+EXPORT_TASK_FIELDS = (
+    "taskId",
+    "name",
+    "series",
+    "classification",
+    "priority",
+    "metaData",
+    "currentStageName",
+    "status",
+    "createdBy",
+    "createdAt",
+    "storageId",
+    "updatedBy",
+    "updatedByUserId",
+    "updatedAt",
+    "consensus",
+    "consensusScore",
+    "consensusTasks",
+    "scores",
+    "superTruth",
+    "datapointClassification",
+)
+
+
+def archive_tasks(task_iterator, output_filepath, compression="none"):
+    """
+    Writes each exported task to a JSON Lines archive as it arrives and yields it on.
+    The archive is compressed while it is written with compression "gzip" or "zstd".
+    """
+    with open(output_filepath, "wb") as raw:
+        f = io.TextIOWrapper(open_compressed_writer(raw, compression), encoding="utf-8")
+        with f:
+            for task in task_iterator:
+                dict_of_tasks = {field: task.get(field) for field in EXPORT_TASK_FIELDS}
+                f.write(json.dumps(dict_of_tasks, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+                yield dict_of_tasks
 
 
-def iterator_to_json(task_iterator, destination, file):
+def iterator_to_json(task_iterator, destination, file, compression="none"):
     """
-    Converts an iterator of OutputTask objects to a JSON string.
+    Streams an iterator of OutputTask objects to a JSON Lines file, one compact task per line.
+    The file is compressed with compression "gzip" or "zstd". Returns the number of tasks written.
+    A failed export is raised, so a partial archive is never uploaded or moves the watermark.
     """
     output_filepath = os.path.join(destination, file)
+    count = 0
 
     try:
-        with open(output_filepath, "w", encoding="utf-8") as f:
-            list_of_tasks = []
-            for task in task_iterator:
-                dict_of_tasks = {
-                    "taskId": task.get("taskId"),
-                    "name": task.get("name"),
-                    "series": task.get("series"),
-                    "classification": task.get("classification"),
-                    "priority": task.get("priority"),
-                    "metaData": task.get("metaData"),
-                    "currentStageName": task.get("currentStageName"),
-                    "status": task.get("status"),
-                    "createdBy": task.get("createdBy"),
-                    "createdAt": task.get("createdAt"),
-                    "storageId": task.get("storageId"),
-                    "updatedBy": task.get("updatedBy"),
-                    "updatedByUserId": task.get("updatedByUserId"),
-                    "updatedAt": task.get("updatedAt"),
-                    "consensus": task.get("consensus"),
-                    "consensusScore": task.get("consensusScore"),
-                    "consensusTasks": task.get("consensusTasks"),
-                    "scores": task.get("scores"),
-                    "superTruth": task.get("superTruth"),
-                    "datapointClassification": task.get("datapointClassification")
-                }
-                list_of_tasks.append(dict_of_tasks)
-
-            json.dump(list_of_tasks, f, ensure_ascii=False, indent=4)
+        for _ in archive_tasks(task_iterator, output_filepath, compression=compression):
+            count += 1
         print(f"JSON data successfully saved to {output_filepath}")
 
     except Exception as e:
-        print(f"Error saving JSON data: {e}")
+        print(f"Error saving JSON data after {count} tasks: {e}")
+        raise
+
+    return count
 
 
 def get_api():
     """Retrieves a secret from Secret Manager."""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/stoked-mode-339213/secrets/api-key/versions/1"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    return get_secret("api-key")
 
 
 def get_org():
     """Retrieves a secret from Secret Manager."""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/stoked-mode-339213/secrets/org/versions/1"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    return get_secret("org")
 
 
 def get_110_project():
     """Retrieves a secret from Secret Manager."""
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/stoked-mode-339213/secrets/project_110/versions/1"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
+    return get_secret("project_110")
+
+
+# Compression of the JSON archive: "none", "gzip" or "zstd"
+ARCHIVE_COMPRESSION = os.environ.get("ARCHIVE_COMPRESSION", "none").lower()
+EXPORT_EXTENSION = f"jsonl{extension(ARCHIVE_COMPRESSION)}"
+ARCHIVE_CONTENT_TYPE = CONTENT_TYPES.get(ARCHIVE_COMPRESSION, "application/x-ndjson")
 
 
-FOLDER_110 = "LungRADS-82-PriorScans-200-single-time-point-"
-move_to_110 = f"/app/{FOLDER_110}"
-export_file_110 = f"/app/{FOLDER_110}/tasks.json"
+def export_folder(project):
+    """Local folder the project's export is written to"""
+    return f"/app/{project['folder']}"
 
-destination_110_json_name = f"{date.today()}-redbrick-lungreds-82-json-input.json"
-destination_110_csv_name = f"{date.today()}-redbrick-lungreds-82-csv-ouput.csv"
 
+def export_file(project):
+    """Local path of the project's JSON Lines archive"""
+    return f"{export_folder(project)}/tasks.{EXPORT_EXTENSION}"
 
-def run_organization():
+
+# Date the outputs of a run are named after. It is fixed once per run, and a sharded job pins it for
+# all of its executions, so a run crossing midnight keeps writing under the day it started.
+RUN_DATE = os.environ.get("RUN_DATE")
+
+
+def run_date(project):
+    """Date of the run a project is part of, set by run_projects"""
+    return project["run_date"]
+
+
+def destination_json_name(project):
+    """Name of the run's JSON archive"""
+    return f"{run_date(project)}-{project['prefix']}-json-input.{EXPORT_EXTENSION}"
+
+
+def destination_csv_name(project):
+    """Name of the run's CSV report"""
+    # gzip reports keep the .csv name and are served decompressed through their Content-Encoding;
+    # GCS does not transcode zstd, so those reports carry the .zst extension instead.
+    suffix = extension(REPORT_COMPRESSION) if REPORT_COMPRESSION == "zstd" else ""
+    return f"{run_date(project)}-{project['prefix']}-csv-ouput.csv{suffix}"
+
+
+def storage_client():
+    """Create a Cloud Storage client, importing the library only once a stage needs it"""
+    from google.cloud import storage
+
+    return storage.Client()
+
+
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "staged")
+# "all" runs the whole pipeline in one container; "archive", "transform" (one shard per job task) and
+# "merge" are the executions of a sharded job.
+JOB_STAGE = os.environ.get("JOB_STAGE", "all")
+# Bounded queues between the overlapped stages: tasks between export/download, archive and transform,
+# report frames between transform and upload. 0 runs the stages one after another on one thread.
+PIPELINE_TASK_QUEUE = int(os.environ.get("PIPELINE_TASK_QUEUE", "256"))
+PIPELINE_FRAME_QUEUE = int(os.environ.get("PIPELINE_FRAME_QUEUE", "2"))
+EXPORT_MODE = os.environ.get("EXPORT_MODE", "full")
+# Merging changes never drops the tasks deleted in RedBrick, so every FULL_REBUILD_DAYS days (0 never), or on a
+# run with FULL_REBUILD=true, an incremental report is rebuilt from a whole export instead.
+FULL_REBUILD_DAYS = int(os.environ.get("FULL_REBUILD_DAYS", "7"))
+FULL_REBUILD = os.environ.get("FULL_REBUILD", "false").lower() == "true"
+
+PROJECT_WORKERS = int(os.environ.get("PROJECT_WORKERS", "4"))
+# "none" exports task metadata only, "cached" also keeps each task's masks in the on-disk mask cache
+# and "export" downloads every mask on every run.
+MASK_MODE = os.environ.get("MASK_MODE", "none")
+
+
+def watermark_blob_name(project):
+    """Name of the project's incremental export state in its output bucket"""
+    return f"state/{project['prefix']}-watermark.json"
+
+
+def read_watermark(project):
+    """
+    Read the incremental export state (newest updatedAt, the report it was merged into and the date of
+    the last full rebuild)
+    """
+    client = storage_client()
+    blob = client.bucket(project["output_bucket"]).blob(watermark_blob_name(project))
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_bytes())
+
+
+def write_watermark(project, updated_at, report_blob_name, rebuilt_on):
+    """Store the incremental export state in the output bucket"""
+    client = storage_client()
+    blob = client.bucket(project["output_bucket"]).blob(watermark_blob_name(project))
+    state = {"updatedAt": updated_at, "report": report_blob_name, "rebuiltOn": rebuilt_on}
+    blob.upload_from_string(json.dumps(state), content_type="application/json")
+    print(f"[{project['name']}] Watermark advanced to {updated_at}.")
+
+
+def is_full_rebuild(project, state):
+    """
+    Whether an incremental run with the watermark state exports the whole project and writes the report
+    from it alone. Every stage of a run decides the same, as the watermark only changes once it ends.
+    """
+    if not state or not state.get("updatedAt") or FULL_REBUILD:
+        return True
+    if not FULL_REBUILD_DAYS:
+        return False
+    rebuilt_on = state.get("rebuiltOn")
+    return not rebuilt_on or (run_date(project) - date.fromisoformat(rebuilt_on)).days >= FULL_REBUILD_DAYS
+
+
+def rebuilt_on(project, state):
+    """Date of the last full rebuild once the run with the watermark state has finished"""
+    return run_date(project).isoformat() if is_full_rebuild(project, state) else state["rebuiltOn"]
+
+
+def export_from_timestamp(project):
+    """Timestamp to export from, or None when the whole project has to be exported"""
+    if EXPORT_MODE != "incremental":
+        return None
+    state = read_watermark(project)
+    if not state or not state.get("updatedAt"):
+        logging.warning(f"[{project['name']}] No watermark found, exporting the whole project")
+        return None
+    if is_full_rebuild(project, state):
+        logging.warning(
+            f"[{project['name']}] Last full rebuild on {state.get('rebuiltOn') or 'an unknown date'}, exporting the "
+            "whole project to drop deleted tasks from the report"
+        )
+        return None
+    logging.warning(f"[{project['name']}] Exporting tasks updated since {state['updatedAt']}")
+    return datetime.fromisoformat(state["updatedAt"]).timestamp()
+
+
+def latest_updated_at(first, second):
+    """Return the newer of two ISO updatedAt strings, either of which may be missing"""
+    if not first or not second:
+        return first or second
+    return max(first, second, key=datetime.fromisoformat)
+
+
+def track_changes(tasks, changes):
+    """Yield tasks while recording their IDs and the newest updatedAt in changes"""
+    for task in tasks:
+        changes["task_ids"].add(task.get("taskId"))
+        changes["updated_at"] = latest_updated_at(changes["updated_at"], task.get("updatedAt"))
+        yield task
+
+
+def new_changes():
+    """Empty record of the tasks seen by track_changes"""
+    return {"task_ids": set(), "updated_at": None}
+
+
+def export_project_tasks(project, from_timestamp=None):
+    """Start the RedBrick export of a registered project and return its task iterator"""
+    import redbrick
+
+    secret_ids = ["api-key", "org"]
+    if not project.get("project_id"):
+        secret_ids.append(project["project_secret"])
+    secrets = get_secrets(secret_ids)
+    project_id = project.get("project_id") or secrets[project["project_secret"]]
+
+    redbrick_project = redbrick.get_project(api_key=secrets["api-key"], org_id=secrets["org"], project_id=project_id)
+    export = redbrick_project.export
+    if MASK_MODE == "export":
+        return export.export_tasks(binary_mask=True, from_timestamp=from_timestamp)
+
+    # The report only reads the segmentMap groups, which the task JSON carries without the masks.
+    tasks = export.export_tasks(without_masks=True, from_timestamp=from_timestamp)
+    if MASK_MODE == "cached":
+        from mask_cache import iter_with_masks
+
+        return iter_with_masks(export, tasks)
+    return tasks
+
+
+def run_organization(project):
     """Run RedBrick Organization"""
-    logging.warning(f"Running data export script")
+    logging.warning(f"[{project['name']}] Running data export script")
     try:
-        api_key = get_api()
-        org_id = get_org()
-        project_110_id = get_110_project()
-
-        os.makedirs(move_to_110, exist_ok=True)
-        file = "tasks.json"
-
-        project_110 = redbrick.get_project(api_key=api_key, org_id=org_id, project_id=project_110_id)
-        export_110_data = project_110.export.export_tasks(binary_mask=True)
-        if export_110_data:
-            logging.warning(f">>>>>>>>>>>>>>>>>>>>>>>>>EXPORTED DATA{export_110_data}")
-            iterator_to_json(export_110_data, move_to_110, file)
-        else:
-            logging.warning(f">>>>>>>>>>>>>>>>>>>>>>>>>THERE IS NO DATA TO BE EXPORTED")
+        os.makedirs(export_folder(project), exist_ok=True)
+        file = f"tasks.{EXPORT_EXTENSION}"
+
+        with stage("export", project) as metrics:
+            export_data = export_project_tasks(project, from_timestamp=export_from_timestamp(project))
+            if export_data:
+                metrics["tasks"] = iterator_to_json(export_data, export_folder(project), file, compression=ARCHIVE_COMPRESSION)
+                metrics["bytes"] = os.path.getsize(export_file(project))
+                logging.warning(f"[{project['name']}] Exported {metrics['tasks']} tasks")
+            else:
+                logging.warning(f">>>>>>>>>>>>>>>>>>>>>>>>>THERE IS NO DATA TO BE EXPORTED")
 
     except subprocess.CalledProcessError as e:
         logging.warning(f"Error running export script: {e.stderr}")
-        exit(1)
+        raise
+
 
+def store_json_file(project, checkpoint=None):
+    """
+    Upload the project's archive. With a checkpoint, an archive identical to the last one recorded is
+    copied from it inside GCS, and the upload is recorded as the archive stage.
+    """
+    from checkpoints import file_md5, upload_if_changed
 
-def store_json_file():
-    """Find Json and Process it"""
-    storage_client = storage.Client()
-    bucket_110 = storage_client.bucket("redbrick-lungreds-82-json-input")
+    client = storage_client()
+    bucket = client.bucket(project["input_bucket"])
+    local_file = export_file(project)
 
     try:
-        blob = bucket_110.blob(f"json/{destination_110_json_name}")
-        blob.upload_from_filename(export_file_110)
-        print(f"File from {export_file_110} uploaded to bucket lung-rads-50B.")
+        blob_name = f"json/{destination_json_name(project)}"
+        md5 = previous_blob_name = None
+        if checkpoint is not None:
+            md5 = file_md5(local_file)
+            last = checkpoint.last_archive
+            if last and last.get("md5") == md5:
+                previous_blob_name = last.get("blob")
+        with stage("upload_archive", project) as metrics:
+            if upload_if_changed(bucket, blob_name, local_file, ARCHIVE_CONTENT_TYPE, previous_blob_name):
+                metrics["bytes"] = os.path.getsize(local_file)
+            else:
+                metrics["bytes"] = 0
+        print(f"File from {local_file} uploaded to bucket {project['input_bucket']}.")
 
     except Exception as e:
-        print(f"Failed to upload file to {export_file_110}. Error: {e}")
+        print(f"Failed to upload file to {local_file}. Error: {e}")
         raise
 
+    if checkpoint is not None:
+        checkpoint.complete("archive", md5=md5, blob=blob_name)
+
+
+# Compression of the CSV report: "none", "gzip" or "zstd"
+REPORT_COMPRESSION = os.environ.get("REPORT_COMPRESSION", "none").lower()
+# Resumable uploads send the report in chunks of this size (a multiple of 256 KiB)
+REPORT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+PREVIOUS_REPORT_CHUNK_ROWS = 50_000
 
-def transform_data_from_bucket_lungrads_110():
+
+def report_content_headers(content_type="text/csv"):
     """
-    Downloads data from a source bucket, transforms it, and saves it to a destination bucket.
+    Content-Type and Content-Encoding of a report in REPORT_COMPRESSION: gzip is a Content-Encoding of
+    the CSV, zstd an application/zstd object named .zst.
     """
-    source_bucket_name = "redbrick-lungreds-82-json-input"
-    source_blob_name = f"json/{destination_110_json_name}"
+    if REPORT_COMPRESSION == "gzip":
+        return content_type, "gzip"
+    return CONTENT_TYPES.get(REPORT_COMPRESSION, content_type), None
 
-    destination_bucket_name = "redbrick-lungreds-82-csv-ouput"
-    destination_blob_name = f"csv/{destination_110_csv_name}"
 
-    storage_client = storage.Client()
+@contextmanager
+def open_report_upload(project, blob_name, content_type="text/csv", metrics=None):
+    """
+    Open a resumable upload to the output bucket as a text stream, compressed while it is written with
+    REPORT_COMPRESSION. The object is only created once the block finishes; on error the upload is cancelled.
+    The number of bytes uploaded is recorded in metrics["bytes"] when a metrics dict is given.
+    """
+    blob = storage_client().bucket(project["output_bucket"]).blob(blob_name)
+    content_type, blob.content_encoding = report_content_headers(content_type)
 
+    raw = blob.open("wb", chunk_size=REPORT_UPLOAD_CHUNK_SIZE, ignore_flush=True, content_type=content_type)
+    stream = open_compressed_writer(raw, REPORT_COMPRESSION)
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
     try:
-        source_bucket = storage_client.bucket(source_bucket_name)
-        source_blob = source_bucket.blob(source_blob_name)
-        json_data_bytes = source_blob.download_as_bytes()
+        yield text
+        text.detach()
+        if stream is not raw:
+            stream.close()
+        if metrics is not None:
+            metrics["bytes"] = raw.tell()
+        raw.close()
+    except BaseException:
+        raw.terminate()
+        raise
+
+
+def open_report_download(project, blob_name):
+    """
+    Open a report in the output bucket as a binary stream, decompressing gzip and zstd reports; reports
+    written before their compression was configured are read as they are.
+    """
+    blob = storage_client().bucket(project["output_bucket"]).blob(blob_name)
+    return open_decompressed(blob.open("rb", raw_download=True))
+
+
+def write_report_csv(frames, stream, header=True):
+    """
+    Write report frames to a text stream as one CSV, returning the number of rows written.
+    Without header only the rows are written, as in every shard but the first.
+    """
+    row_count = 0
+    for frame in frames:
+        frame.to_csv(stream, index=False, header=header)
+        header = False
+        row_count += len(frame)
+    if header:
+        csv.writer(stream, lineterminator="\n").writerow(COLUMNS)
+    return row_count
+
+
+def iter_previous_report(project, report_blob_name, changed_task_ids):
+    """Stream a previously uploaded report in chunks, without the rows of changed tasks"""
+    import pandas as pd
+
+    print(f"[{project['name']}] Merging {len(changed_task_ids)} changed tasks into {report_blob_name}.")
+    with open_report_download(project, report_blob_name) as f:
+        for chunk in pd.read_csv(f, dtype=str, keep_default_na=False, chunksize=PREVIOUS_REPORT_CHUNK_ROWS):
+            unchanged = chunk[~chunk["Task ID"].isin(changed_task_ids)]
+            yield unchanged.reindex(columns=list(COLUMNS), fill_value="")
+
+
+PARQUET_OUTPUT = os.environ.get("PARQUET_OUTPUT", "false").lower() == "true"
+# "local" keeps the per-task row cache in ROW_CACHE_DIR, "bucket" in the output bucket; unset disables it.
+ROW_CACHE = os.environ.get("ROW_CACHE", "")
+# Record finished stages in the output bucket so a retried run resumes instead of starting over
+CHECKPOINTS = os.environ.get("CHECKPOINTS", "true").lower() == "true"
+# Bump when the row builder or the flag rules change without a change to the columns or the flag names,
+# so the last report is rebuilt instead of being reused for an unchanged archive.
+REPORT_VERSION = 1
+# Keep an indexed SQLite copy of the report rows in the output bucket for QC lookups
+QUERY_STORE = os.environ.get("QUERY_STORE", "false").lower() == "true"
 
-        json_data_string = json_data_bytes.decode("utf-8")
-        raw_data = json.loads(json_data_string)
 
-        df = create_a_data_frame(raw_data)
-        new_df = recreate_new_dataframe(df)
+def report_version():
+    """Digest of what shapes the report: REPORT_VERSION, the row builder version, the columns and the flags"""
+    from flagging import FLAG_RULES
+    from row_cache import ROW_CACHE_VERSION
 
-        csv_buffer = io.StringIO()
-        new_df.to_csv(csv_buffer, index=False)
-        csv_string = csv_buffer.getvalue()
+    payload = json.dumps([REPORT_VERSION, ROW_CACHE_VERSION, COLUMNS, [flag for flag, _, _ in FLAG_RULES]])
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
 
-        destination_bucket = storage_client.bucket(destination_bucket_name)
-        destination_blob = destination_bucket.blob(destination_blob_name)
-        destination_blob.upload_from_string(csv_string, content_type="text/csv")
 
-        print(f"Data transformed and uploaded to {destination_blob_name} successfully.")
+def project_store_name(project, shard=None):
+    """Name of the project's persistent row cache or query store, one per shard"""
+    return project["prefix"] if shard is None else f"{project['prefix']}-shard-{shard[0]:05d}-of-{shard[1]:05d}"
+
+
+@contextmanager
+def open_project_row_cache(project, shard=None):
+    """The project's row cache (one per shard), or None when ROW_CACHE is not set"""
+    if not ROW_CACHE:
+        yield None
+        return
+    from row_cache import open_row_cache
+
+    bucket = storage_client().bucket(project["output_bucket"]) if ROW_CACHE == "bucket" else None
+    with open_row_cache(project_store_name(project, shard), bucket) as cache:
+        yield cache
+
+
+def tee_frames(frames, write):
+    """Pass every frame to an additional output on its way through"""
+    for frame in frames:
+        write(frame)
+        yield frame
+
+
+def publish_report(project, frames, changes, shard=None):
+    """
+    Stream report frames into today's CSV in the output bucket, into the partitioned Parquet copy when
+    PARQUET_OUTPUT is set and into the SQLite query store when QUERY_STORE is set. When exporting
+    incrementally the changed rows are merged into the previous cumulative report and the watermark
+    is advanced. A shard (index, count) writes its part of the report for merge_report_shards instead.
+    """
+    with stage("publish", project) as metrics:
+        # Transforming and uploading interleave; transform_seconds is the share spent producing frames.
+        frames = timed(frames, metrics, "transform_seconds")
+        row_count = write_report(project, frames, changes, metrics, shard)
+        metrics["tasks"] = len(changes["task_ids"])
+        metrics["rows"] = row_count
+
+
+def write_report(project, frames, changes, metrics, shard=None):
+    """Write the report outputs of publish_report and return the number of CSV rows"""
+    report_blob_name = f"csv/{destination_csv_name(project)}"
+    blob_name = report_blob_name
+    if shard is not None:
+        from sharding import shard_blob_name, shard_frames, write_shard_summary
+
+        blob_name = shard_blob_name(report_blob_name, *shard)
+
+    state = None
+    if EXPORT_MODE == "incremental":
+        # Only the day's changes are held in memory; the previous report is streamed.
+        changed_frames = list(frames)
+        state = read_watermark(project) or {}
+        frames = changed_frames
+        # A full rebuild writes the report from the whole export alone, dropping tasks deleted since.
+        if state.get("report") and not is_full_rebuild(project, state):
+            previous = iter_previous_report(project, state["report"], changes["task_ids"])
+            if shard is not None:
+                previous = shard_frames(previous, *shard)
+            frames = chain(previous, changed_frames)
+
+    bucket = storage_client().bucket(project["output_bucket"])
+    with ExitStack() as outputs:
+        if PARQUET_OUTPUT:
+            from parquet_output import open_parquet_report
+
+            part = "part-0" if shard is None else f"part-{shard[0]:05d}"
+            parquet_report = open_parquet_report(bucket, run_date(project), prefix=f"parquet/{project['prefix']}", part=part)
+            frames = tee_frames(frames, outputs.enter_context(parquet_report))
+        if QUERY_STORE:
+            from query_store import open_query_store
+
+            query_store = open_query_store(bucket, project_store_name(project, shard))
+            frames = tee_frames(frames, outputs.enter_context(query_store))
+        stream = outputs.enter_context(open_report_upload(project, blob_name, metrics=metrics))
+        row_count = write_report_csv(frames, stream, header=shard is None or shard[0] == 0)
+    print(f"[{project['name']}] {row_count} rows transformed and uploaded to {blob_name} successfully.")
+
+    if shard is not None:
+        # The merge step composes the shards and advances the watermark once every shard has finished.
+        summary = {"rows": row_count, "tasks": len(changes["task_ids"]), "updated_at": changes["updated_at"]}
+        write_shard_summary(bucket, report_blob_name, *shard, summary)
+    elif state is not None:
+        updated_at = latest_updated_at(state.get("updatedAt"), changes["updated_at"])
+        write_watermark(project, updated_at, report_blob_name, rebuilt_on(project, state))
+    return row_count
+
+
+def transform_data_from_bucket_lungrads_110(project, shard=None):
+    """
+    Downloads data from a source bucket, transforms it, and saves it to a destination bucket.
+    With a shard (index, count) only the tasks of that shard are transformed.
+    """
+    source_blob_name = f"json/{destination_json_name(project)}"
+
+    client = storage_client()
+
+    try:
+        source_bucket = client.bucket(project["input_bucket"])
+        source_blob = source_bucket.blob(source_blob_name)
+        changes = new_changes()
+        download_metrics = {}
+
+        # Tasks are parsed one at a time from the read stream and transformed as they arrive,
+        # so the archive is never held in memory; the download is logged once it has been read.
+        # Download, transform and upload overlap on their own threads.
+        with source_blob.open("rb", raw_download=True) as f, open_project_row_cache(project, shard) as cache:
+            raw_data = timed(iter_tasks(f), download_metrics, "wall_seconds")
+            if shard is not None:
+                from sharding import shard_tasks
+
+                raw_data = shard_tasks(raw_data, *shard)
+            raw_data = overlapped(raw_data, PIPELINE_TASK_QUEUE, f"{project['name']}-download")
+            frames = iter_report_frames(track_changes(raw_data, changes), cache=cache)
+            frames = overlapped(frames, PIPELINE_FRAME_QUEUE, f"{project['name']}-transform")
+            publish_report(project, frames, changes, shard)
+            download_metrics["bytes"] = f.tell()
+        download_metrics["tasks"] = len(changes["task_ids"])
+        log_stage("download", project, download_metrics)
 
     except Exception as e:
         print(f"An error occurred: {e}")
         raise
 
 
-if __name__ == "__main__":
+def run_fused_pipeline(project, checkpoint=None):
+    """
+    Transforms tasks straight from the RedBrick export iterator, skipping the bucket round-trip.
+    The export, the archive writer, the transform and the report upload each run on their own thread
+    with bounded queues in between, and the raw archive is uploaded to the input bucket in the
+    background as soon as the export has been read, recording it in the checkpoint when there is one.
+    """
+    logging.warning(f"[{project['name']}] Running fused export and transform")
+    os.makedirs(export_folder(project), exist_ok=True)
+
+    changes = new_changes()
+    export_metrics = {}
+    export_data = export_project_tasks(project, from_timestamp=export_from_timestamp(project))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        archive_uploads = []
+
+        def archived_tasks():
+            # The export is read while the report is published; its share is logged as a stage of its own.
+            tasks = overlapped(export_data, PIPELINE_TASK_QUEUE, f"{project['name']}-export")
+            tasks = timed(tasks, export_metrics, "wall_seconds")
+            # Counted here, as the transform thread filling changes may still be a queue behind.
+            export_metrics["tasks"] = 0
+            for task in archive_tasks(tasks, export_file(project), compression=ARCHIVE_COMPRESSION):
+                export_metrics["tasks"] += 1
+                yield task
+            export_metrics["bytes"] = os.path.getsize(export_file(project))
+            log_stage("export", project, export_metrics)
+            archive_uploads.append(executor.submit(store_json_file, project, checkpoint))
+
+        with open_project_row_cache(project) as cache:
+            archived = overlapped(archived_tasks(), PIPELINE_TASK_QUEUE, f"{project['name']}-archive")
+            frames = iter_report_frames(track_changes(archived, changes), cache=cache)
+            frames = overlapped(frames, PIPELINE_FRAME_QUEUE, f"{project['name']}-transform")
+            publish_report(project, frames, changes)
+        for archive_upload in archive_uploads:
+            archive_upload.result()
+
+
+def reuse_unchanged_report(project, checkpoint, archive_md5):
+    """
+    Reuse the last published report when the same report version built it from an identical archive:
+    it is kept when it already is today's report, and copied to today's name otherwise. The copy happens inside GCS, so a
+    day without changes costs no transform and no upload.
+    """
+    last = checkpoint.last_publish
+    if not last or last.get("input_md5") != archive_md5:
+        return False
+    # A report built by other code or written in another compression is rebuilt rather than copied.
+    if last.get("version") != report_version() or last.get("compression", "none") != REPORT_COMPRESSION:
+        return False
+    report_blob_name = f"csv/{destination_csv_name(project)}"
+    same_day = last.get("report") == report_blob_name
+    # Today's Parquet partition only exists when the last report was published today.
+    if PARQUET_OUTPUT and not same_day:
+        return False
+
+    bucket = storage_client().bucket(project["output_bucket"])
+    previous = bucket.get_blob(last["report"])
+    if previous is None:
+        return False
+    # The query store holds the same rows as the last report, unless it has not been built yet.
+    if QUERY_STORE:
+        from query_store import query_store_blob_name
+
+        if not bucket.blob(query_store_blob_name(project_store_name(project))).exists():
+            return False
+    if same_day:
+        print(f"[{project['name']}] Archive unchanged, {report_blob_name} is up to date.")
+    else:
+        bucket.copy_blob(previous, bucket, report_blob_name)
+        print(f"[{project['name']}] Archive unchanged since {last['report']}, copied it to {report_blob_name}.")
+    return True
+
+
+def archive_project(project, checkpoint=None):
+    """Export the project and upload its archive, unless an earlier attempt of this run already did"""
+    if checkpoint is not None and checkpoint.done("archive"):
+        logging.warning(f"[{project['name']}] Archive already uploaded by this run, skipping the export")
+        return
+
+    run_organization(project)
+
+    # Records the archive stage only once the whole export is archived and uploaded; a failed export raises above.
+    store_json_file(project, checkpoint)
+
+
+def run_staged_pipeline(project, checkpoint=None):
+    """
+    Export and archive the project, then transform the archive. With a checkpoint, stages finished by an
+    earlier attempt of this run are skipped and an unchanged archive reuses the last report.
+    """
+    archive_project(project, checkpoint)
+
+    if checkpoint is None:
+        transform_data_from_bucket_lungrads_110(project)
+    elif checkpoint.done("publish"):
+        logging.warning(f"[{project['name']}] Report already published by this run, skipping the transform")
+    else:
+        archive_md5 = checkpoint.get("archive")["md5"]
+        if not reuse_unchanged_report(project, checkpoint, archive_md5):
+            transform_data_from_bucket_lungrads_110(project)
+        checkpoint.complete(
+            "publish",
+            input_md5=archive_md5,
+            report=f"csv/{destination_csv_name(project)}",
+            compression=REPORT_COMPRESSION,
+            version=report_version(),
+        )
+
+
+def merge_report_shards(project, count):
+    """
+    Compose the shard CSVs of today's report into the report itself inside GCS, advance the watermark
+    when exporting incrementally and remove the shards. A marker records that the report and watermark
+    are written, so a retried merge only finishes removing the shards.
+    """
+    from sharding import compose, delete_blobs, merged_marker_name, read_shard_summaries, shard_blob_name
+
+    bucket = storage_client().bucket(project["output_bucket"])
+    report_blob_name = f"csv/{destination_csv_name(project)}"
+    marker = bucket.blob(merged_marker_name(report_blob_name, count))
+
+    if marker.exists():
+        logging.warning(f"[{project['name']}] {report_blob_name} is already merged, removing the remaining shards")
+    else:
+        with stage("merge", project) as metrics:
+            summaries = read_shard_summaries(bucket, report_blob_name, count)
+            sources = [shard_blob_name(report_blob_name, index, count) for index in range(count)]
+            compose(bucket, sources, report_blob_name, *report_content_headers())
+            metrics["shards"] = count
+            metrics["tasks"] = sum(summary["tasks"] for summary in summaries)
+            metrics["rows"] = sum(summary["rows"] for summary in summaries)
+        print(f"[{project['name']}] {count} shards with {metrics['rows']} rows composed into {report_blob_name}.")
+
+        if QUERY_STORE:
+            from query_store import merge_query_stores
+
+            names = [project_store_name(project, (index, count)) for index in range(count)]
+            merge_query_stores(bucket, names, project_store_name(project))
+
+        if EXPORT_MODE == "incremental":
+            state = read_watermark(project) or {}
+            updated_at = state.get("updatedAt")
+            for summary in summaries:
+                updated_at = latest_updated_at(updated_at, summary["updated_at"])
+            write_watermark(project, updated_at, report_blob_name, rebuilt_on(project, state))
+
+        marker.upload_from_string(json.dumps({"report": report_blob_name}), content_type="application/json")
+
+    extensions = ("csv", "json")
+    delete_blobs(bucket, [shard_blob_name(report_blob_name, i, count, ext) for ext in extensions for i in range(count)])
+    marker.delete()
+
+
+def run_project(project):
+    """
+    Export, archive and transform one project in the configured pipeline mode, or run one JOB_STAGE
+    of a sharded job: archive once, transform on every job task, then merge once.
+    """
+    checkpoint = None
+    if CHECKPOINTS:
+        from checkpoints import Checkpoint
+
+        checkpoint = Checkpoint(storage_client().bucket(project["output_bucket"]), project["prefix"])
+
+    with stage("project", project):
+        if JOB_STAGE == "archive":
+            archive_project(project, checkpoint)
+        elif JOB_STAGE == "transform":
+            from sharding import SHARD_COUNT, TASK_INDEX
+
+            transform_data_from_bucket_lungrads_110(project, shard=(TASK_INDEX, SHARD_COUNT))
+        elif JOB_STAGE == "merge":
+            from sharding import SHARD_COUNT
+
+            merge_report_shards(project, SHARD_COUNT)
+        elif PIPELINE_MODE == "fused":
+            if checkpoint is not None and checkpoint.done("publish"):
+                logging.warning(f"[{project['name']}] Already exported by this run, skipping")
+                return
+            run_fused_pipeline(project, checkpoint)
+            if checkpoint is not None:
+                checkpoint.complete("publish", report=f"csv/{destination_csv_name(project)}")
+        else:
+            run_staged_pipeline(project, checkpoint)
+
+
+def run_projects(projects, workers=PROJECT_WORKERS, day=None):
+    """
+    Run every project on a bounded thread pool, all under the same run date (day, today by default).
+    A failing project is logged and does not stop the others; the names of the failed projects are
+    returned.
+    """
+    day = day or date.today()
+    projects = [dict(project, run_date=day) for project in projects]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(projects)))) as executor:
+        futures = {executor.submit(run_project, project): project["name"] for project in projects}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                logging.warning(f"[{name}] Finished")
+            except Exception:
+                logging.exception(f"[{name}] Failed")
+                failed.append(name)
+    return failed
+
+
+def main():
+    """Run the daily export for every registered project"""
     logging.warning("Starting the daily export...")
 
-    run_organization()
+    projects = load_projects()
+    failed = run_projects(projects, day=date.fromisoformat(RUN_DATE) if RUN_DATE else None)
+    if failed:
+        logging.error(f"{len(failed)} of {len(projects)} projects failed: {', '.join(sorted(failed))}")
+        sys.exit(1)
 
-    store_json_file()
 
-    transform_data_from_bucket_lungrads_110()
+if __name__ == "__main__":
+    main()
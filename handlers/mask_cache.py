@@ -0,0 +1,60 @@
+"""On-disk cache of exported segmentation masks, keyed by task ID and updatedAt"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+MASK_CACHE_DIR = os.environ.get("MASK_CACHE_DIR", "/app/mask-cache")
+
+# Written last, so a directory without it is a partial export and is fetched again
+COMPLETE_MARKER = ".complete"
+
+
+def safe_name(value):
+    """A file-system safe version of a task ID or timestamp"""
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(value))
+
+
+def task_cache_dir(task, cache_dir=MASK_CACHE_DIR):
+    """Directory holding the masks of one version of a task"""
+    return os.path.join(cache_dir, safe_name(task["taskId"]), safe_name(task.get("updatedAt")))
+
+
+def is_cached(task, cache_dir=MASK_CACHE_DIR):
+    """Whether the masks of this version of the task are in the cache"""
+    return os.path.exists(os.path.join(task_cache_dir(task, cache_dir), COMPLETE_MARKER))
+
+
+def fetch_masks(export, task, cache_dir=MASK_CACHE_DIR):
+    """
+    Export the binary masks of a single task into the cache, replacing older versions of the task.
+    The export is written to a temporary directory and moved into place once it is complete.
+    """
+    task_dir = os.path.join(cache_dir, safe_name(task["taskId"]))
+    os.makedirs(task_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=task_dir, prefix=".partial-")
+    try:
+        for _ in export.export_tasks(task_id=task["taskId"], binary_mask=True, destination=staging):
+            pass
+        open(os.path.join(staging, COMPLETE_MARKER), "w").close()
+
+        for version in os.listdir(task_dir):
+            path = os.path.join(task_dir, version)
+            if path != staging:
+                shutil.rmtree(path, ignore_errors=True)
+        os.rename(staging, task_cache_dir(task, cache_dir))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def iter_with_masks(export, tasks, cache_dir=MASK_CACHE_DIR):
+    """Yield tasks from a metadata-only export, making sure each task's masks are in the cache first"""
+    fetched = 0
+    for task in tasks:
+        if not is_cached(task, cache_dir):
+            fetch_masks(export, task, cache_dir)
+            fetched += 1
+        yield task
+    logging.warning(f"Fetched masks of {fetched} tasks into {cache_dir}")
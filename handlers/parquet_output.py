@@ -0,0 +1,89 @@
+"""Columnar copy of the report as Parquet, partitioned by export date and stage"""
+import os
+import tempfile
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from report_schema import COLUMNS, MEASUREMENT_COLUMNS, MISSING
+
+PARTITION_COLUMN = "Stage"
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+CATEGORY_COLUMNS = ("Clinician Name", "Status")
+TIMESTAMP_COLUMN = "Updated At"
+TIMESTAMP_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+
+def parquet_type(column):
+    """Arrow type of a report column in the Parquet files"""
+    if column in MEASUREMENT_COLUMNS:
+        return pa.float64()
+    if column == TIMESTAMP_COLUMN:
+        return pa.timestamp("s")
+    if column in CATEGORY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+PARQUET_SCHEMA = pa.schema(
+    [pa.field(column, parquet_type(column)) for column in COLUMNS if column != PARTITION_COLUMN]
+)
+
+
+def to_parquet_table(frame):
+    """
+    Convert a report frame (fresh or re-read from CSV) to an Arrow table with typed columns. The
+    MISSING placeholder of the CSV is null in every column.
+    """
+    data = {}
+    for field in PARQUET_SCHEMA:
+        values = frame[field.name]
+        values = values.mask(values == MISSING)
+        if pa.types.is_floating(field.type):
+            data[field.name] = pd.to_numeric(values, errors="coerce")
+        elif pa.types.is_timestamp(field.type):
+            data[field.name] = pd.to_datetime(values, format=TIMESTAMP_FORMAT, errors="coerce")
+        else:
+            data[field.name] = values.astype("string")
+    table = pa.Table.from_pandas(pd.DataFrame(data), preserve_index=False)
+    return table.cast(PARQUET_SCHEMA)
+
+
+def partition_path(export_date, stage):
+    """Hive-style path of one export date / stage partition; a missing stage is the null partition"""
+    missing = stage is None or stage != stage or stage in ("", MISSING)
+    stage = NULL_PARTITION if missing else quote(str(stage), safe="")
+    return f"export_date={export_date}/stage={stage}"
+
+
+@contextmanager
+def open_parquet_report(bucket, export_date, prefix="parquet", part="part-0"):
+    """
+    Yield a function that appends report frames to one Parquet file per stage, each frame becoming a
+    row group. The files are uploaded to bucket under prefix when the block finishes without error;
+    writers of the same partitions (such as shards) need distinct part names.
+    """
+    writers = {}
+    with tempfile.TemporaryDirectory() as directory:
+
+        def write(frame):
+            stages = frame[PARTITION_COLUMN].astype("object")
+            for stage, rows in frame.groupby(stages, sort=False, dropna=False):
+                path = partition_path(export_date, stage)
+                if path not in writers:
+                    local_path = os.path.join(directory, f"{len(writers)}.parquet")
+                    writers[path] = (local_path, pq.ParquetWriter(local_path, PARQUET_SCHEMA, compression="zstd"))
+                writers[path][1].write_table(to_parquet_table(rows))
+
+        try:
+            yield write
+        finally:
+            for _, writer in writers.values():
+                writer.close()
+
+        for path, (local_path, _) in writers.items():
+            blob_name = f"{prefix}/{path}/{part}.parquet"
+            bucket.blob(blob_name).upload_from_filename(local_path, content_type="application/vnd.apache.parquet")
+        print(f"Parquet report written to {len(writers)} stage partitions of {prefix}/export_date={export_date}.")
@@ -0,0 +1,72 @@
+"""Overlapping the stages of the job on threads connected by bounded queues"""
+import queue
+import threading
+from contextlib import nullcontext
+
+from instrumentation import current_stage
+
+# How often a producer blocked on a full queue checks whether its consumer has gone away
+POLL_SECONDS = 0.1
+
+_ITEM, _DONE, _ERROR = range(3)
+
+
+def overlapped(iterable, maxsize, name=None):
+    """
+    Produce the items of iterable on a background thread while the caller consumes them.
+    At most maxsize items wait in between, so a fast producer is held back by a slow consumer.
+    Errors of the producer are raised in the consumer; when the consumer stops early the producer is
+    stopped and its iterator closed. With maxsize <= 0 the iterable is consumed inline.
+    The producer thread counts towards the CPU time and profile of the stage its consumer works for.
+    """
+    if maxsize <= 0:
+        return iter(iterable)
+    return _overlapped(iterable, maxsize, name)
+
+
+def _overlapped(iterable, maxsize, name):
+    handoff = queue.Queue(maxsize)
+    stop = threading.Event()
+    # The generator body first runs on the consumer's thread, inside the stage it works for.
+    run = current_stage()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                handoff.put(entry, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        with run.attach() if run is not None else nullcontext():
+            produce_items()
+
+    def produce_items():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((_ITEM, item)):
+                    return
+        except BaseException as e:
+            put((_ERROR, e))
+            return
+        finally:
+            if stop.is_set() and hasattr(iterator, "close"):
+                iterator.close()
+        put((_DONE, None))
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = handoff.get()
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
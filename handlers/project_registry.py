@@ -0,0 +1,48 @@
+"""Registry of the RedBrick projects exported by the daily job"""
+import json
+import os
+
+# JSON list of projects; see projects.json for the fields of an entry.
+REGISTRY_FILE = os.environ.get(
+    "PROJECT_REGISTRY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "projects.json")
+)
+# Name of a Secret Manager secret holding the registry, used instead of REGISTRY_FILE when set.
+REGISTRY_SECRET = os.environ.get("PROJECT_REGISTRY_SECRET")
+# Comma-separated project names to run; every registered project when unset.
+PROJECT_FILTER = os.environ.get("PROJECTS")
+
+REQUIRED_KEYS = ("name", "folder", "input_bucket", "output_bucket", "prefix")
+
+
+def validate_projects(projects):
+    """Raise ValueError when a registry entry is incomplete or a project name is repeated"""
+    names = set()
+    for project in projects:
+        missing = [key for key in REQUIRED_KEYS if not project.get(key)]
+        if not project.get("project_id") and not project.get("project_secret"):
+            missing.append("project_id or project_secret")
+        if missing:
+            raise ValueError(f"Project {project.get('name', '?')} is missing {', '.join(missing)}")
+        if project["name"] in names:
+            raise ValueError(f"Project {project['name']} is registered twice")
+        names.add(project["name"])
+
+
+def load_projects():
+    """Load, validate and filter the project registry"""
+    if REGISTRY_SECRET:
+        from secret_store import get_secret
+
+        projects = json.loads(get_secret(REGISTRY_SECRET))
+    else:
+        with open(REGISTRY_FILE, encoding="utf-8") as f:
+            projects = json.load(f)
+    validate_projects(projects)
+
+    if PROJECT_FILTER:
+        selected = {name.strip() for name in PROJECT_FILTER.split(",") if name.strip()}
+        unknown = selected - {project["name"] for project in projects}
+        if unknown:
+            raise ValueError(f"Unknown projects in PROJECTS: {', '.join(sorted(unknown))}")
+        projects = [project for project in projects if project["name"] in selected]
+    return projects
@@ -0,0 +1,240 @@
+"""
+Indexed SQLite copy of the report rows for QC lookups, kept in the output bucket and updated in place.
+Rows are in report_rows under their report column names (see SQL_COLUMN_NAMES), with indexes on
+"Task ID", "Clinician Name" and "Stage"; the comma-joined "Flagged" is normalized into row_flags, and
+flagged_rows joins the two:
+
+    SELECT * FROM flagged_rows WHERE "Clinician Name" = ?
+    SELECT DISTINCT "Task ID" FROM flagged_rows WHERE flag = 'LungRADS Score Mismatch'
+    SELECT "Stage", flag, count(*) FROM flagged_rows GROUP BY "Stage", flag
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+from report_schema import COLUMNS
+from sqlite_batches import select_in
+
+# Stores written by another report layout are rebuilt from scratch.
+SCHEMA_VERSION = zlib.crc32(json.dumps([1, COLUMNS]).encode("utf-8")) & 0x7FFFFFFF
+INDEXED_COLUMNS = ("Task ID", "Clinician Name", "Stage")
+TABLES = ("report_rows", "row_flags", "tasks", "store_info")
+
+# SQLite column names ignore case, so the series' "Segment Path" cannot sit next to "Segment path".
+SQL_COLUMN_NAMES = {"Segment Path": "Series Segment Path"}
+SQL_COLUMNS = tuple(SQL_COLUMN_NAMES.get(column, column) for column in COLUMNS)
+COLUMN_LIST = ", ".join(f'"{column}"' for column in SQL_COLUMNS)
+INSERT_ROWS = f"INSERT INTO report_rows (row_id, {COLUMN_LIST}) VALUES ({', '.join('?' * (len(COLUMNS) + 1))})"
+DELETE_TASK_FLAGS = 'DELETE FROM row_flags WHERE row_id IN (SELECT row_id FROM report_rows WHERE "Task ID" = ?)'
+DELETE_TASK_ROWS = 'DELETE FROM report_rows WHERE "Task ID" = ?'
+
+
+def create_schema(connection):
+    """Create the tables, indexes and views of an empty store"""
+    columns = ", ".join(f'"{column}" TEXT' for column in SQL_COLUMNS)
+    connection.execute(f"CREATE TABLE report_rows (row_id INTEGER PRIMARY KEY, {columns})")
+    for column in INDEXED_COLUMNS:
+        name = column.lower().replace(" ", "_")
+        connection.execute(f'CREATE INDEX report_rows_{name} ON report_rows ("{column}")')
+    connection.execute(
+        "CREATE TABLE row_flags (flag TEXT NOT NULL, row_id INTEGER NOT NULL, PRIMARY KEY (flag, row_id)) WITHOUT ROWID"
+    )
+    connection.execute("CREATE INDEX row_flags_row_id ON row_flags (row_id)")
+    # The digest of each task's rows decides whether they are rewritten; run marks the tasks still reported.
+    connection.execute("CREATE TABLE tasks (task_id TEXT PRIMARY KEY, digest TEXT, run TEXT NOT NULL)")
+    connection.execute("CREATE INDEX tasks_run ON tasks (run)")
+    connection.execute("CREATE TABLE store_info (key TEXT PRIMARY KEY, value TEXT)")
+    connection.execute(
+        "CREATE VIEW flagged_rows AS SELECT row_flags.flag AS flag, report_rows.* "
+        "FROM row_flags JOIN report_rows USING (row_id)"
+    )
+    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def open_database(path):
+    """Connect to a store, recreating it when it is missing or has another schema version"""
+    connection = sqlite3.connect(path)
+    # The file is a private copy that is only uploaded once it has been written completely.
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        connection.execute("DROP VIEW IF EXISTS flagged_rows")
+        for table in TABLES:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+        create_schema(connection)
+    return connection
+
+
+def mark_updated(connection):
+    """Record when the store was last written"""
+    updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    connection.execute("INSERT OR REPLACE INTO store_info VALUES ('updated_at', ?)", (updated_at,))
+
+
+def report_text(frame):
+    """The report columns of a frame as the strings the CSV holds, so re-read reports compare equal"""
+    text = frame[list(COLUMNS)].astype("object")
+    return text.where(text.notna(), "").astype(str)
+
+
+def row_flags(flagged):
+    """The individual flags of a comma-joined "Flagged" value"""
+    return {flag for flag in flagged.split(",") if flag}
+
+
+class QueryStore:
+    """
+    Report rows of every task, replaced task by task when their digest changes. Tasks of the store that
+    the run did not report again are removed when it finishes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = open_database(path)
+        self.run = uuid.uuid4().hex
+        self.next_row_id = (self.connection.execute("SELECT max(row_id) FROM report_rows").fetchone()[0] or 0) + 1
+        self.pending = None
+        self.unchanged = 0
+        self.written = 0
+
+    def write(self, frame):
+        """Add the rows of a report frame"""
+        import pandas as pd
+
+        text = report_text(frame)
+        if self.pending is not None:
+            text = pd.concat([self.pending, text], ignore_index=True)
+        if not len(text):
+            return
+        # Previous reports are read in fixed-size chunks, so the last task may continue in the next frame.
+        last = text["Task ID"].to_numpy() == text["Task ID"].iloc[-1]
+        self.pending = text[last].reset_index(drop=True)
+        self.update(text[~last].reset_index(drop=True))
+
+    def update(self, text):
+        """Rewrite the tasks of a frame whose rows changed, and mark every task as reported"""
+        import pandas as pd
+
+        if not len(text):
+            return
+        hashes = pd.util.hash_pandas_object(text, index=False).to_numpy()
+        positions = text.groupby("Task ID", sort=False).indices
+        task_ids = list(positions)
+        query = "SELECT task_id, digest, run FROM tasks WHERE task_id IN ({})"
+        stored = {task_id: (digest, run) for task_id, digest, run in select_in(self.connection, query, task_ids)}
+
+        rows = text.to_numpy().tolist()
+        flagged = COLUMNS.index("Flagged")
+        unchanged, replaced, inserts, flags, states = [], [], [], [], []
+        for task_id, task_positions in positions.items():
+            digest = hashlib.blake2b(hashes[task_positions].tobytes(), digest_size=16).hexdigest()
+            digest_stored, run = stored.get(task_id, (None, None))
+            if run == self.run:
+                # Rows of a task that already appeared in this run are appended; the next run rewrites it.
+                digest = None
+            elif digest_stored == digest:
+                unchanged.append((self.run, task_id))
+                continue
+            else:
+                replaced.append((task_id,))
+            states.append((task_id, digest, self.run))
+            for position in task_positions:
+                row = rows[position]
+                inserts.append([self.next_row_id, *row])
+                flags.extend((flag, self.next_row_id) for flag in row_flags(row[flagged]))
+                self.next_row_id += 1
+
+        self.connection.executemany("UPDATE tasks SET run = ? WHERE task_id = ?", unchanged)
+        self.connection.executemany(DELETE_TASK_FLAGS, replaced)
+        self.connection.executemany(DELETE_TASK_ROWS, replaced)
+        self.connection.executemany(INSERT_ROWS, inserts)
+        self.connection.executemany("INSERT INTO row_flags VALUES (?, ?)", flags)
+        self.connection.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?)", states)
+        self.unchanged += len(unchanged)
+        self.written += len(states)
+
+    def finish(self):
+        """Write the last pending task, remove the tasks that are no longer reported and commit"""
+        if self.pending is not None:
+            self.update(self.pending)
+            self.pending = None
+        gone = "SELECT task_id FROM tasks WHERE run != ?"
+        self.connection.execute(
+            f'DELETE FROM row_flags WHERE row_id IN (SELECT row_id FROM report_rows WHERE "Task ID" IN ({gone}))',
+            (self.run,),
+        )
+        self.connection.execute(f'DELETE FROM report_rows WHERE "Task ID" IN ({gone})', (self.run,))
+        removed = self.connection.execute("DELETE FROM tasks WHERE run != ?", (self.run,)).rowcount
+        mark_updated(self.connection)
+        self.connection.commit()
+        self.connection.execute("PRAGMA optimize")
+        logging.warning(
+            f"Query store {self.path}: {self.written} tasks written, {self.unchanged} unchanged, {removed} removed"
+        )
+
+    def close(self):
+        """Close the database file"""
+        self.connection.close()
+
+
+def query_store_blob_name(name):
+    """Blob of the query store called name in the output bucket"""
+    return f"query/{name}.sqlite"
+
+
+@contextmanager
+def open_query_store(bucket, name):
+    """
+    Yield a function that adds report frames to the query store called name. The store is downloaded
+    from the bucket first and uploaded again only when the block finishes without error.
+    """
+    blob = bucket.blob(query_store_blob_name(name))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "query.sqlite")
+        if blob.exists():
+            blob.download_to_filename(path)
+        store = QueryStore(path)
+        try:
+            yield store.write
+            store.finish()
+        finally:
+            store.close()
+        blob.upload_from_filename(path, content_type="application/vnd.sqlite3")
+
+
+def merge_query_stores(bucket, names, name):
+    """
+    Combine the query stores of the shards into the store called name. The shard stores stay in the
+    bucket, where each keeps being updated in place by its shard.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "query.sqlite")
+        connection = open_database(path)
+        for index, shard_name in enumerate(names):
+            shard_path = os.path.join(directory, f"{index}.sqlite")
+            bucket.blob(query_store_blob_name(shard_name)).download_to_filename(shard_path)
+            offset = connection.execute("SELECT coalesce(max(row_id), 0) FROM report_rows").fetchone()[0]
+            connection.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+            # Row ids are offset past the rows of the shards before, keeping the flags of each row attached.
+            connection.execute(
+                f"INSERT INTO report_rows (row_id, {COLUMN_LIST}) "
+                f"SELECT row_id + ?, {COLUMN_LIST} FROM shard.report_rows",
+                (offset,),
+            )
+            connection.execute("INSERT INTO row_flags SELECT flag, row_id + ? FROM shard.row_flags", (offset,))
+            connection.execute("INSERT INTO tasks SELECT * FROM shard.tasks")
+            connection.commit()
+            connection.execute("DETACH DATABASE shard")
+            os.remove(shard_path)
+        mark_updated(connection)
+        connection.commit()
+        connection.execute("PRAGMA optimize")
+        connection.close()
+        bucket.blob(query_store_blob_name(name)).upload_from_filename(path, content_type="application/vnd.sqlite3")
@@ -0,0 +1,127 @@
+"""Column layout of the LungRADS report rows"""
+
+MISSING = "----"
+
+COLUMNS = (
+    "Task ID",
+    "Name",
+    "Clinician Name",
+    "Updated At",
+    "Status",
+    "Stage",
+    "Nodule Centroid",
+    "Nodule Location",
+    "Nodule Type",
+    "Confidence on Nodule Type",
+    "Comments on Nodule Type",
+    "Nodule Morphology",
+    "Confidence on Nodule Morphology",
+    "Comments on Nodule Morphology",
+    "Nodule-wise LungRADS Score",
+    "Confidence on LungRADS Score",
+    "Comments on LungRADS Score",
+    "Nodule Suspicion Rank (1-5)",
+    "Entity Comments",
+    "Nodule Volume 2D Mean Diameter",
+    "Nodule Volume 2D Max Diameter",
+    "Nodule Volume 2D Min Diameter",
+    "Nodule Core 2D Mean Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Max Diameter (Only for part-solid nodules)",
+    "Nodule Core 2D Min Diameter (Only for part-solid nodules)",
+    "Classification (Study Reviewed?)",
+    "Classification (Case-wise LungRADS Score)",
+    "Classification (Confidence on LungRADS Score)",
+    "Classification (Comments on LungRADS Score)",
+    "Segment path",
+    "Flagged",
+    "Segment Path",
+)
+
+# Bookkeeping columns read by the flagging stage and dropped before output
+INTERNAL_COLUMNS = (
+    "Row Kind",
+    "Annotation",
+    "Volume Linked",
+)
+
+ROW_COLUMNS = COLUMNS + INTERNAL_COLUMNS
+
+COLUMN_INDEX = {column: index for index, column in enumerate(ROW_COLUMNS)}
+
+TASK_ID = COLUMN_INDEX["Task ID"]
+NAME = COLUMN_INDEX["Name"]
+CLINICIAN_NAME = COLUMN_INDEX["Clinician Name"]
+UPDATED_AT = COLUMN_INDEX["Updated At"]
+STATUS = COLUMN_INDEX["Status"]
+STAGE = COLUMN_INDEX["Stage"]
+NODULE_CENTROID = COLUMN_INDEX["Nodule Centroid"]
+NODULE_LOCATION = COLUMN_INDEX["Nodule Location"]
+SEGMENT_PATH = COLUMN_INDEX["Segment path"]
+FLAGGED = COLUMN_INDEX["Flagged"]
+SERIES_SEGMENT_PATH = COLUMN_INDEX["Segment Path"]
+ROW_KIND = COLUMN_INDEX["Row Kind"]
+ANNOTATION = COLUMN_INDEX["Annotation"]
+VOLUME_LINKED = COLUMN_INDEX["Volume Linked"]
+
+# Row Kind values
+NODULE_ROW = "nodule"
+NO_NODULE_ROW = "no nodule"
+EMPTY_ROW = "empty"
+
+# RedBrick landmark attribute -> column
+NODULE_ATTRIBUTE_COLUMNS = tuple(
+    (attribute, COLUMN_INDEX[attribute])
+    for attribute in (
+        "Nodule Location",
+        "Nodule Type",
+        "Confidence on Nodule Type",
+        "Comments on Nodule Type",
+        "Nodule Morphology",
+        "Confidence on Nodule Morphology",
+        "Comments on Nodule Morphology",
+        "Nodule-wise LungRADS Score",
+        "Confidence on LungRADS Score",
+        "Comments on LungRADS Score",
+        "Nodule Suspicion Rank (1-5)",
+        "Entity Comments",
+    )
+)
+
+# RedBrick classification attribute -> column
+CLASSIFICATION_ATTRIBUTE_COLUMNS = tuple(
+    (attribute, COLUMN_INDEX[f"Classification ({attribute})"])
+    for attribute in (
+        "Study Reviewed?",
+        "Case-wise LungRADS Score",
+        "Confidence on LungRADS Score",
+        "Comments on LungRADS Score",
+    )
+)
+
+# RedBrick measurement category -> column
+MEASUREMENT_COLUMNS = {
+    category: COLUMN_INDEX[category]
+    for category in (
+        "Nodule Volume 2D Min Diameter",
+        "Nodule Volume 2D Max Diameter",
+        "Nodule Volume 2D Mean Diameter",
+        "Nodule Core 2D Min Diameter (Only for part-solid nodules)",
+        "Nodule Core 2D Max Diameter (Only for part-solid nodules)",
+        "Nodule Core 2D Mean Diameter (Only for part-solid nodules)",
+    )
+}
+
+# Columns that repeat a handful of values across the whole report
+CATEGORICAL_COLUMNS = ("Clinician Name", "Status", "Stage")
+
+ROW_TEMPLATE = [MISSING] * len(ROW_COLUMNS)
+ROW_TEMPLATE[FLAGGED] = ""
+ROW_TEMPLATE[SERIES_SEGMENT_PATH] = None
+ROW_TEMPLATE[ROW_KIND] = EMPTY_ROW
+ROW_TEMPLATE[ANNOTATION] = -1
+ROW_TEMPLATE[VOLUME_LINKED] = True
+
+
+def new_row():
+    """A fresh report row with every column at its default"""
+    return ROW_TEMPLATE.copy()
@@ -0,0 +1,138 @@
+"""Persistent per-task cache of transformed report rows"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+
+from report_schema import ROW_COLUMNS
+from sqlite_batches import select_in
+
+ROW_CACHE_DIR = os.environ.get("ROW_CACHE_DIR", "/app/row-cache")
+# Least recently used tasks beyond this many are evicted when the cache is closed
+ROW_CACHE_MAX_TASKS = int(os.environ.get("ROW_CACHE_MAX_TASKS", "500000"))
+
+# Bump when the row builder changes without a change to ROW_COLUMNS, so stale rows are rebuilt.
+ROW_CACHE_VERSION = 1
+FINGERPRINT_SEED = json.dumps([ROW_CACHE_VERSION, ROW_COLUMNS])
+
+# Task fields the row builder reads, and the fields that version each superTruth or consensus annotation
+TASK_FIELDS = ("taskId", "name", "currentStageName", "status", "updatedAt")
+ANNOTATION_FIELDS = ("updatedBy", "updatedAt", "status")
+
+
+def annotation_versions(annotation):
+    """The version fields of a superTruth or consensus task, None when it is missing"""
+    if not isinstance(annotation, dict):
+        return None
+    return [annotation.get(field) for field in ANNOTATION_FIELDS]
+
+
+def fingerprint(task):
+    """
+    Digest of what the rows of a task are built from. RedBrick stamps a new updatedAt on the task and
+    on the annotation whenever labels change, so the annotations are versioned by their updatedAt
+    instead of hashing their (much larger) series.
+    """
+    consensus = task.get("consensusTasks")
+    payload = json.dumps(
+        [
+            [task.get(field) for field in TASK_FIELDS],
+            annotation_versions(task.get("superTruth")),
+            [annotation_versions(annotation) for annotation in consensus] if isinstance(consensus, list) else None,
+        ],
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.blake2b((FINGERPRINT_SEED + payload).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RowCache:
+    """Rows of each task keyed by taskId, valid while the task's fingerprint is unchanged"""
+
+    def __init__(self, path, max_tasks=ROW_CACHE_MAX_TASKS):
+        self.path = path
+        self.max_tasks = max_tasks
+        self.used_at = int(time.time())
+        self.hits = 0
+        self.misses = 0
+        # Created by the project thread and used by its transform thread, one at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS task_rows "
+            "(task_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, rows TEXT NOT NULL, used_at INTEGER NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS task_rows_used_at ON task_rows (used_at)")
+
+    def lookup(self, tasks):
+        """Return (fingerprint, cached rows or None) for each of a chunk of tasks, in one query"""
+        keys = [fingerprint(task) for task in tasks]
+        task_ids = [task["taskId"] for task in tasks]
+        query = "SELECT task_id, fingerprint, rows FROM task_rows WHERE task_id IN ({})"
+        cached = {task_id: (key, rows) for task_id, key, rows in select_in(self.connection, query, task_ids)}
+
+        found = []
+        hits = []
+        for task_id, key in zip(task_ids, keys):
+            entry = cached.get(task_id)
+            if entry is not None and entry[0] == key:
+                found.append((key, json.loads(entry[1])))
+                hits.append((self.used_at, task_id))
+            else:
+                found.append((key, None))
+        self.connection.executemany("UPDATE task_rows SET used_at = ? WHERE task_id = ?", hits)
+        self.hits += len(hits)
+        self.misses += len(found) - len(hits)
+        return found
+
+    def store(self, task, key, rows):
+        """Cache the rows of a task under the fingerprint returned by lookup"""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO task_rows VALUES (?, ?, ?, ?)",
+            (task["taskId"], key, json.dumps(rows, separators=(",", ":")), self.used_at),
+        )
+
+    def close(self):
+        """Evict the least recently used tasks over max_tasks and write the cache to disk"""
+        self.connection.execute(
+            "DELETE FROM task_rows WHERE task_id IN "
+            "(SELECT task_id FROM task_rows ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_tasks,),
+        )
+        self.connection.commit()
+        self.connection.close()
+        logging.warning(f"Row cache {self.path}: {self.hits} hits, {self.misses} misses")
+
+
+@contextmanager
+def open_row_cache(name, bucket=None):
+    """
+    Open the row cache called name. With a bucket the cache lives in cache/{name}-rows.sqlite and is
+    downloaded first and uploaded again when the block succeeds; otherwise it stays in ROW_CACHE_DIR.
+    """
+    if bucket is None:
+        os.makedirs(ROW_CACHE_DIR, exist_ok=True)
+        cache = RowCache(os.path.join(ROW_CACHE_DIR, f"{name}-rows.sqlite"))
+        try:
+            yield cache
+        finally:
+            cache.close()
+        return
+
+    blob = bucket.blob(f"cache/{name}-rows.sqlite")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rows.sqlite")
+        if blob.exists():
+            blob.download_to_filename(path)
+        cache = RowCache(path)
+        try:
+            yield cache
+        except BaseException:
+            cache.connection.rollback()
+            cache.close()
+            raise
+        cache.close()
+        blob.upload_from_filename(path, content_type="application/vnd.sqlite3")
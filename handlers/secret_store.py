@@ -0,0 +1,92 @@
+"""Cached Secret Manager access shared by every stage of the job"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+SECRET_PROJECT = "stoked-mode-339213"
+
+# Seconds a fetched secret stays valid; 0 keeps it for the life of the process.
+SECRET_CACHE_TTL = float(os.environ.get("SECRET_CACHE_TTL", "0"))
+# Optional JSON file that keeps secrets across runs on the same machine (written with 0600 permissions).
+SECRET_CACHE_FILE = os.environ.get("SECRET_CACHE_FILE")
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """The single Secret Manager client of this process"""
+    from google.cloud import secretmanager
+
+    return secretmanager.SecretManagerServiceClient()
+
+
+def fetch_secret(secret_id, version="1"):
+    """Retrieves a secret from Secret Manager, bypassing the cache."""
+    name = f"projects/{SECRET_PROJECT}/secrets/{secret_id}/versions/{version}"
+    response = get_client().access_secret_version(request={"name": name})
+    return response.payload.data.decode("UTF-8")
+
+
+def is_fresh(entry):
+    """Whether a cache entry is still inside the TTL"""
+    return not SECRET_CACHE_TTL or time.time() - entry["fetched_at"] < SECRET_CACHE_TTL
+
+
+def load_cache_file():
+    """Read the on-disk cache, ignoring a missing or unreadable file"""
+    if not SECRET_CACHE_FILE or not os.path.exists(SECRET_CACHE_FILE):
+        return {}
+    try:
+        with open(SECRET_CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable secret cache {SECRET_CACHE_FILE}: {e}")
+        return {}
+
+
+def save_cache_file():
+    """Write the in-memory cache to the on-disk cache, readable by the owner only"""
+    fd = os.open(SECRET_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(_cache, f)
+
+
+def get_secrets(secret_ids, version="1"):
+    """
+    Return {secret_id: value} for the requested secrets.
+    Secrets that are not cached yet are fetched concurrently over the shared client, without holding
+    the cache lock, so a slow fetch does not hold up threads whose secrets are already cached.
+    """
+    keys = {secret_id: f"{secret_id}/versions/{version}" for secret_id in secret_ids}
+
+    with _cache_lock:
+        if not _cache:
+            _cache.update(load_cache_file())
+        entries = {secret_id: _cache.get(key) for secret_id, key in keys.items()}
+    secrets = {secret_id: entry["value"] for secret_id, entry in entries.items() if entry and is_fresh(entry)}
+    missing = [secret_id for secret_id in keys if secret_id not in secrets]
+    if not missing:
+        return secrets
+
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        fetched = dict(zip(missing, executor.map(lambda secret_id: fetch_secret(secret_id, version), missing)))
+    fetched_at = time.time()
+
+    with _cache_lock:
+        for secret_id, value in fetched.items():
+            _cache[keys[secret_id]] = {"value": value, "fetched_at": fetched_at}
+        if SECRET_CACHE_FILE:
+            save_cache_file()
+    secrets.update(fetched)
+    return secrets
+
+
+def get_secret(secret_id, version="1"):
+    """Return one secret, from the cache when possible"""
+    return get_secrets([secret_id], version)[secret_id]
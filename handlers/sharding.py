@@ -0,0 +1,95 @@
+"""Splitting the transform across Cloud Run job tasks and composing their outputs in GCS"""
+import json
+import os
+import zlib
+
+TASK_INDEX = int(os.environ.get("CLOUD_RUN_TASK_INDEX", "0"))
+TASK_COUNT = int(os.environ.get("CLOUD_RUN_TASK_COUNT", "1"))
+# Shards of the transform; the single-task merge execution sets it to the transform's task count.
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", TASK_COUNT))
+
+# Most source objects a single GCS compose request accepts
+COMPOSE_LIMIT = 32
+
+
+def shard_of(task_id, count):
+    """Shard of a task; stable across processes, unlike hash()"""
+    return zlib.crc32(str(task_id).encode("utf-8")) % count
+
+
+def shard_tasks(tasks, index, count):
+    """Yield the tasks that belong to shard index of count"""
+    for task in tasks:
+        if shard_of(task["taskId"], count) == index:
+            yield task
+
+
+def shard_frames(frames, index, count):
+    """Yield the rows of report frames whose Task ID belongs to shard index of count"""
+    for frame in frames:
+        yield frame[frame["Task ID"].map(lambda task_id: shard_of(task_id, count)) == index]
+
+
+def shard_blob_name(report_blob_name, index, count, extension="csv"):
+    """Name of one shard's part of a report"""
+    return f"shards/{report_blob_name}/{index:05d}-of-{count:05d}.{extension}"
+
+
+def merged_marker_name(report_blob_name, count):
+    """Name of the marker the merge writes once the report and watermark are written"""
+    return f"shards/{report_blob_name}/merged-of-{count:05d}.json"
+
+
+def delete_blobs(bucket, names):
+    """Delete blobs by name, skipping the ones already gone so a retried cleanup finishes"""
+    from google.api_core.exceptions import NotFound
+
+    for name in names:
+        try:
+            bucket.blob(name).delete()
+        except NotFound:
+            pass
+
+
+def write_shard_summary(bucket, report_blob_name, index, count, summary):
+    """Store what a shard wrote, for the merge step"""
+    blob = bucket.blob(shard_blob_name(report_blob_name, index, count, "json"))
+    blob.upload_from_string(json.dumps(summary), content_type="application/json")
+
+
+def read_shard_summaries(bucket, report_blob_name, count):
+    """Summaries of every shard of a report; raises RuntimeError when a shard has not finished"""
+    summaries = []
+    for index in range(count):
+        blob = bucket.blob(shard_blob_name(report_blob_name, index, count, "json"))
+        if not blob.exists():
+            raise RuntimeError(f"Shard {index} of {count} of {report_blob_name} has not finished")
+        summaries.append(json.loads(blob.download_as_bytes()))
+    return summaries
+
+
+def compose(bucket, source_names, destination_name, content_type, content_encoding=None):
+    """
+    Concatenate source blobs into destination_name without downloading them. More than COMPOSE_LIMIT
+    sources are composed in levels through intermediate objects, which are deleted afterwards.
+    """
+    sources = [bucket.blob(name) for name in source_names]
+    intermediates = []
+    level = 0
+    while len(sources) > COMPOSE_LIMIT:
+        grouped = []
+        for start in range(0, len(sources), COMPOSE_LIMIT):
+            blob = bucket.blob(f"{destination_name}.compose-{level}-{start // COMPOSE_LIMIT}")
+            blob.content_type = content_type
+            blob.compose(sources[start:start + COMPOSE_LIMIT])
+            grouped.append(blob)
+        intermediates.extend(grouped)
+        sources = grouped
+        level += 1
+
+    destination = bucket.blob(destination_name)
+    destination.content_type = content_type
+    destination.content_encoding = content_encoding
+    destination.compose(sources)
+    for blob in intermediates:
+        blob.delete()
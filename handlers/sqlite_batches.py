@@ -0,0 +1,14 @@
+"""Batched lookups shared by the SQLite stores"""
+
+# SQLite limits the number of bound parameters of a statement, so long lists of values are split.
+BATCH_SIZE = 500
+
+
+def select_in(connection, query, values):
+    """
+    Yield the rows of query for a list of values, where query holds one "IN ({})" for the values and
+    is run once per batch of BATCH_SIZE
+    """
+    for start in range(0, len(values), BATCH_SIZE):
+        batch = values[start:start + BATCH_SIZE]
+        yield from connection.execute(query.format(",".join("?" * len(batch))), batch)
@@ -0,0 +1,100 @@
+"""Incremental parsing of exported tasks from a binary stream"""
+import io
+import json
+
+from compression import open_decompressed
+
+# Characters read from the stream at a time while looking for the end of a task in a JSON array
+READ_CHUNK_CHARS = 1024 * 1024
+WHITESPACE = " \t\r\n"
+DELIMITERS = WHITESPACE + ",]"
+
+
+def iter_json_array(text, buffer="", chunk_chars=READ_CHUNK_CHARS):
+    """
+    Yield the items of a JSON array from a text stream one at a time, starting with the already
+    read buffer. Only the item being parsed is buffered, so memory is bounded by the largest task.
+    """
+    decoder = json.JSONDecoder()
+    position = 0
+    eof = False
+    read_chars = chunk_chars
+    # What comes next: "[" to open the array, the "first" item or "]", a "separator" or "]" after an
+    # item, or an "item" after a separator.
+    expect = "["
+
+    while True:
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("Unterminated JSON array")
+            buffer, position = text.read(chunk_chars), 0
+            eof = not buffer
+            continue
+
+        char = buffer[position]
+        if expect == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            expect = "first"
+            position += 1
+            continue
+        if expect == "separator" or (expect == "first" and char == "]"):
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' after an item of the JSON array, got {char!r}")
+            expect = "item"
+            position += 1
+            continue
+        if char in ",]":
+            raise ValueError(f"Expected an item of the JSON array, got {char!r}")
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            item, end = None, len(buffer)
+        # An item is complete once whitespace, a separator or "]" follows it; until then a number or
+        # literal cut off by the end of a chunk (12 of 12345, -1 of -1.5) may continue in the next one.
+        if end == len(buffer) or buffer[end] not in DELIMITERS:
+            if not eof:
+                # Reading twice as much each time keeps re-decoding a large task from its start linear.
+                more = text.read(read_chars)
+                read_chars *= 2
+                eof = not more
+                buffer, position = buffer[position:] + more, 0
+                continue
+            if end < len(buffer):
+                raise ValueError(f"Unexpected {buffer[end]!r} after an item of the JSON array")
+        yield item
+        expect = "separator"
+        position = end
+        read_chars = chunk_chars
+
+
+def iter_tasks(stream):
+    """
+    Yield exported tasks from a binary stream holding JSON Lines, gzip- or zstd-compressed JSON Lines or
+    a legacy JSON array. The stream must be seekable so the format can be sniffed; it is not closed.
+    """
+    text = io.TextIOWrapper(open_decompressed(stream), encoding="utf-8")
+    try:
+        first = text.read(1)
+        while first.isspace():
+            first = text.read(1)
+        if first == "[":
+            yield from iter_json_array(text, buffer=first)
+            return
+        if first:
+            # The first line has lost its first character to the sniffing above.
+            yield json.loads(first + text.readline())
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        # Leave the stream open for the caller, who owns it.
+        if not text.closed:
+            text.detach()